@@ -21,21 +21,36 @@ from __future__ import print_function
 import apt
 from apt.cache import FetchFailedException
 import apt_pkg
+import bisect
+import bz2
+import concurrent.futures
+import copy
 import difflib
+import errno
 import fnmatch
+import functools
 import glob
 import hashlib
+import gzip
+import json
 import logging
 import lsb_release
+import lzma
+import mmap
+import multiprocessing
 import os
 import re
 import shutil
+import sqlite3
 import stat
 import subprocess
+import sys
 import tarfile
 import tempfile
+import threading
 import time
 
+from contextlib import contextmanager
 from io import BytesIO, open
 
 if "APT_CLONE_DEBUG_RESOLVER" in os.environ:
@@ -90,21 +105,1452 @@ class LowLevelCommands(object):
         return (ret == 0)
 
 
+# supported compression for the state file: suffix and default level
+COMPRESSION = {
+    "gzip": (".tar.gz", 9),
+    "zstd": (".tar.zst", 3),
+    "xz": (".tar.xz", 6),
+    "none": (".tar", None),
+}
+
+
+class _PipeFile(object):
+    """ file-like wrapper around a (de)compressor subprocess """
+
+    def __init__(self, cmd, path, mode):
+        self.cmd = cmd
+        self._eof = False
+        if mode == "wb":
+            self._fp = open(path, "wb")
+            self._proc = subprocess.Popen(
+                cmd, stdin=subprocess.PIPE, stdout=self._fp)
+            self._pipe = self._proc.stdin
+        else:
+            self._fp = open(path, "rb")
+            self._proc = subprocess.Popen(
+                cmd, stdin=self._fp, stdout=subprocess.PIPE)
+            self._pipe = self._proc.stdout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, data):
+        return self._pipe.write(data)
+
+    def read(self, size=-1):
+        data = self._pipe.read(size)
+        if not data:
+            self._eof = True
+        return data
+
+    def close(self):
+        if self._pipe is None:
+            return
+        reading = self._proc.stdout is not None
+        self._pipe.close()
+        self._pipe = None
+        ret = self._proc.wait()
+        self._fp.close()
+        # a reader that stopped early makes the decompressor fail, that
+        # is fine
+        if reading and not self._eof:
+            return
+        if ret != 0:
+            raise IOError("'%s' failed with exit code %i" % (
+                " ".join(self.cmd), ret))
+
+
+def _find_program(name):
+    for path in os.environ.get("PATH", "/usr/bin:/bin").split(os.pathsep):
+        if os.access(os.path.join(path, name), os.X_OK):
+            return os.path.join(path, name)
+    return None
+
+
+def _open_compressed(path, compression="gzip", level=None, threads=1):
+    """ open path for writing a compressed stream, the external
+        compressors are used when threads are asked for (or if there is
+        no python module for the compression)
+    """
+    if compression not in COMPRESSION:
+        raise ValueError("unknown compression '%s'" % compression)
+    if level is None:
+        level = COMPRESSION[compression][1]
+    if compression == "gzip":
+        if threads > 1 and _find_program("pigz"):
+            return _PipeFile(
+                ["pigz", "-c", "-p", str(threads), "-%i" % level], path, "wb")
+        return gzip.open(path, "wb", compresslevel=level)
+    if compression == "xz":
+        if threads > 1 and _find_program("xz"):
+            return _PipeFile(
+                ["xz", "-c", "-T", str(threads), "-%i" % level], path, "wb")
+        return lzma.open(path, "wb", preset=level)
+    if compression == "zstd":
+        if not _find_program("zstd"):
+            raise IOError("no 'zstd' found")
+        return _PipeFile(
+            ["zstd", "-q", "-c", "-T%i" % threads, "-%i" % level], path, "wb")
+    return open(path, "wb")
+
+
+# magic bytes of the compressions we can read
+COMPRESSION_MAGIC = [
+    (b"\x1f\x8b", "gzip"),
+    (b"BZh", "bzip2"),
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+]
+
+# magic bytes of data that is already compressed and is not worth
+# compressing again (debs, zip, images, ...)
+PRECOMPRESSED_MAGIC = [magic for (magic, compression) in COMPRESSION_MAGIC] + [
+    b"!<arch>\ndebian",
+    b"PK\x03\x04",
+    b"\x89PNG",
+    b"\xff\xd8\xff",
+    b"\x04\x22\x4d\x18",
+]
+
+# pax headers used for members that are compressed on their own
+PAX_COMPRESSION = "APT-CLONE.compression"
+PAX_SIZE = "APT-CLONE.size"
+# pax global header at the start of clone files that have a member index
+PAX_INDEXED = "APT-CLONE.indexed"
+
+
+def _get_compression_from_magic(magic):
+    for (m, compression) in COMPRESSION_MAGIC:
+        if magic.startswith(m):
+            return compression
+    return None
+
+
+def _open_decompressed(path):
+    """ open path for reading and transparently decompress it based
+        on the magic bytes at the start of the file
+    """
+    with open(path, "rb") as fp:
+        magic = fp.read(6)
+    compression = _get_compression_from_magic(magic)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "bzip2":
+        return bz2.BZ2File(path, "rb")
+    if compression == "xz":
+        return lzma.open(path, "rb")
+    if compression == "zstd":
+        if not _find_program("zstd"):
+            raise IOError("no 'zstd' found to read '%s'" % path)
+        return _PipeFile(["zstd", "-q", "-d", "-c"], path, "rb")
+    return open(path, "rb")
+
+
+def _get_file_digest(path):
+    """ return the sha256 digest of the file at path """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for data in iter(lambda: fp.read(1024 * 1024), b""):
+            sha256.update(data)
+    return "sha256:" + sha256.hexdigest()
+
+
+def _get_md5(path, chunk_size=64 * 1024):
+    """ return the md5 hexdigest of the file at path """
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        for data in iter(lambda: fp.read(chunk_size), b""):
+            md5.update(data)
+    return md5.hexdigest()
+
+
+def _compress_member(src, size, compression, level=None):
+    """ compress size bytes from src and return a file object that
+        contains the compressed data
+    """
+    if level is None:
+        level = COMPRESSION[compression][1]
+    dst = tempfile.TemporaryFile()
+    if compression == "zstd":
+        proc = subprocess.Popen(["zstd", "-q", "-c", "-%i" % level],
+                                stdin=subprocess.PIPE, stdout=dst)
+        out = proc.stdin
+    elif compression == "xz":
+        out = lzma.LZMAFile(dst, "wb", preset=level)
+    else:
+        out = gzip.GzipFile(fileobj=dst, mode="wb", compresslevel=level,
+                            mtime=0)
+    while size > 0:
+        data = src.read(min(size, 1024 * 1024))
+        if not data:
+            raise IOError("unexpected end of data")
+        out.write(data)
+        size -= len(data)
+    out.close()
+    if compression == "zstd" and proc.wait() != 0:
+        raise IOError("zstd failed")
+    dst.seek(0)
+    return dst
+
+
+def _open_member_decompressed(fileobj, compression):
+    """ return a file object with the decompressed data of a member that
+        was compressed with _compress_member()
+    """
+    if compression == "gzip":
+        return gzip.GzipFile(fileobj=fileobj, mode="rb")
+    if compression == "xz":
+        return lzma.LZMAFile(fileobj, "rb")
+    if compression == "zstd":
+        tmp = tempfile.NamedTemporaryFile()
+        shutil.copyfileobj(fileobj, tmp)
+        tmp.flush()
+        pipe = _PipeFile(["zstd", "-q", "-d", "-c"], tmp.name, "rb")
+        # keep the tempfile alive as long as the pipe
+        pipe.tmp = tmp
+        return pipe
+    raise IOError("unknown member compression '%s'" % compression)
+
+
+class MemberCompressedTarFile(tarfile.TarFile):
+    """ a (uncompressed) tar file that compresses every regular file
+        member on its own
+
+        Data that is already compressed (debs, compressed extra files)
+        is stored as it is, everything else is compressed with
+        member_compression (or nothing is compressed if that is None).
+        Compressed members are marked with pax headers so that
+        StateArchive can decompress them transparently.
+
+        On close a index with the header offset of every member is
+        appended as the last member, this allows StateArchive to read
+        single members without walking over all the tar headers. Open
+        it with the PAX_INDEXED global header so that readers know
+        there is a index to look for.
+    """
+    INDEX_NAME = "./var/lib/apt-clone/index"
+
+    member_compression = "gzip"
+    member_compression_level = None
+    _index = None
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self._index is None:
+            self._index = []
+        self._index.append((tarinfo.name, self.offset))
+        if (fileobj is None or not tarinfo.isreg() or tarinfo.size == 0 or
+                self.member_compression is None):
+            return super(MemberCompressedTarFile, self).addfile(
+                tarinfo, fileobj)
+        pos = fileobj.tell()
+        magic = fileobj.read(16)
+        fileobj.seek(pos)
+        for m in PRECOMPRESSED_MAGIC:
+            if magic.startswith(m):
+                return super(MemberCompressedTarFile, self).addfile(
+                    tarinfo, fileobj)
+        with _compress_member(fileobj, tarinfo.size, self.member_compression,
+                              self.member_compression_level) as data:
+            tarinfo = copy.copy(tarinfo)
+            tarinfo.pax_headers = dict(tarinfo.pax_headers)
+            tarinfo.pax_headers[PAX_COMPRESSION] = self.member_compression
+            tarinfo.pax_headers[PAX_SIZE] = str(tarinfo.size)
+            tarinfo.size = os.fstat(data.fileno()).st_size
+            return super(MemberCompressedTarFile, self).addfile(
+                tarinfo, data)
+
+    def close(self):
+        if not self.closed and self.mode != "r":
+            index = "".join("%i %s\n" % (offset, name)
+                            for (name, offset) in self._index or [])
+            index = index.encode("utf-8")
+            tarinfo = tarfile.TarInfo(self.INDEX_NAME)
+            tarinfo.size = len(index)
+            tarinfo.mtime = time.time()
+            super(MemberCompressedTarFile, self).addfile(
+                tarinfo, BytesIO(index))
+        super(MemberCompressedTarFile, self).close()
+
+
+class _VirtualTarInfo(tarfile.TarInfo):
+    """ a member that is not in the tar but computed (from a delta) """
+    __slots__ = ("data",)
+
+
+class StateArchive(object):
+    """ read-only view of a apt-clone state file
+
+        The compressed tar stream is decompressed exactly once into a
+        spool file and all members are indexed by their name (without
+        the "./" prefix), so that lookups and extractions afterwards
+        never need to rescan or re-decompress the archive. Uncompressed
+        tar files (like the ones with compressed members written by
+        MemberCompressedTarFile) are read in place.
+
+        Delta clone files are resolved against their base clone: members
+        that are not in the delta are served from the base (chain) and
+        installed.pkgs is computed from the base and the package delta.
+    """
+    DELTA_PKGS = "var/lib/apt-clone/delta.pkgs"
+    DELTA_REMOVED = "var/lib/apt-clone/delta-removed"
+
+    # keep small state files in memory, spill larger ones to disk
+    SPOOL_MAX_SIZE = 16 * 1024 * 1024
+    # how far from the end to look for the member index
+    INDEX_MAX_SEARCH = 64 * 1024 * 1024
+
+    def __init__(self, statefile):
+        self.statefile = statefile
+        with open(statefile, "rb") as fp:
+            magic = fp.read(6)
+        index = None
+        if _get_compression_from_magic(magic) is None:
+            self._spool = open(statefile, "rb")
+            if self._has_index():
+                index = self._read_index()
+            self._spool.seek(0)
+        else:
+            self._spool = tempfile.SpooledTemporaryFile(
+                max_size=self.SPOOL_MAX_SIZE)
+            with _open_decompressed(statefile) as fp:
+                shutil.copyfileobj(fp, self._spool, 1024 * 1024)
+            self._spool.seek(0)
+        self._tar = tarfile.open(fileobj=self._spool, mode="r:")
+        self._members = {}
+        self._order = []
+        self.prefix = ""
+        if index is None:
+            # no index, walk over all the headers
+            index = ((m.name, m) for m in self._tar)
+        for (rawname, m) in index:
+            name = self._normalize(rawname)
+            if not name:
+                continue
+            # for indexed archives m is the header offset, the TarInfo
+            # is only read when the member is used
+            self._members[name] = m
+            self._order.append(name)
+            # detect prefix, the last member decides just like it
+            # always did
+            if rawname.startswith("./"):
+                self.prefix = "./"
+            else:
+                self.prefix = ""
+        self._base = None
+        self._removed = set()
+        if self.DELTA_PKGS in self._members:
+            try:
+                self._open_base()
+            except Exception:
+                self.close()
+                raise
+
+    def _open_base(self):
+        manifest = apt_pkg.TagSection(self.read("var/lib/apt-clone/manifest"))
+        base = os.path.join(os.path.dirname(os.path.abspath(self.statefile)),
+                            manifest["Base"])
+        if not os.path.exists(base):
+            raise IOError("base clone '%s' of '%s' not found" % (
+                base, self.statefile))
+        if _get_file_digest(base) != manifest["Base-Digest"]:
+            raise IOError("base clone '%s' of '%s' has changed" % (
+                base, self.statefile))
+        self._base = StateArchive(base)
+        if self.DELTA_REMOVED in self._members:
+            self._removed = set(
+                self.read(self.DELTA_REMOVED).decode("utf-8").splitlines())
+        # apply the package delta to the installed.pkgs of the base
+        installed = {}
+        f = self._base.extractfile("var/lib/apt-clone/installed.pkgs")
+        for line in f.readlines():
+            line = line.decode("utf-8")
+            if line.strip() == "" or line.startswith("#"):
+                continue
+            installed[line.split()[0]] = line
+        f = self.extractfile(self.DELTA_PKGS)
+        for line in f.readlines():
+            (op, pkg) = line.decode("utf-8").split(" ", 1)
+            if op == "-":
+                del installed[pkg.strip()]
+            else:
+                installed[pkg.split()[0]] = pkg
+        tarinfo = _VirtualTarInfo("var/lib/apt-clone/installed.pkgs")
+        tarinfo.data = "".join(
+            installed[name] for name in sorted(installed)).encode("utf-8")
+        tarinfo.size = len(tarinfo.data)
+        tarinfo.mtime = self.getmember(self.DELTA_PKGS).mtime
+        self._members["var/lib/apt-clone/installed.pkgs"] = tarinfo
+        self._order.append("var/lib/apt-clone/installed.pkgs")
+
+    def _has_index(self):
+        """ check for the PAX_INDEXED global header at the start of the
+            (uncompressed) tar
+        """
+        fp = self._spool
+        fp.seek(0)
+        try:
+            tarinfo = tarfile.TarInfo.frombuf(
+                fp.read(tarfile.BLOCKSIZE), tarfile.ENCODING,
+                "surrogateescape")
+        except tarfile.HeaderError:
+            return False
+        if tarinfo.type != tarfile.XGLTYPE:
+            return False
+        data = fp.read(min(tarinfo.size, tarfile.RECORDSIZE))
+        return (" %s=1\n" % PAX_INDEXED).encode("utf-8") in data
+
+    def _read_index(self):
+        """ find the index written by MemberCompressedTarFile at the end
+            of the (uncompressed) tar, returns a list of (name, offset)
+            or None if there is no index
+        """
+        names = [(prefix + MemberCompressedTarFile.INDEX_NAME[2:] +
+                  "\0").encode("utf-8") for prefix in ("./", "")]
+        fp = self._spool
+        fp.seek(0, os.SEEK_END)
+        end = fp.tell()
+        tail = 64 * 1024
+        while True:
+            start = max(0, end - tail)
+            start -= start % tarfile.BLOCKSIZE
+            fp.seek(start)
+            buf = fp.read(end - start)
+            # the index header is the last header in the tar
+            for pos in range(len(buf) - tarfile.BLOCKSIZE, -1,
+                             -tarfile.BLOCKSIZE):
+                block = buf[pos:pos + tarfile.BLOCKSIZE]
+                if not (block.startswith(names[0]) or
+                        block.startswith(names[1])):
+                    continue
+                try:
+                    tarinfo = tarfile.TarInfo.frombuf(
+                        block, tarfile.ENCODING, "surrogateescape")
+                except tarfile.HeaderError:
+                    continue
+                fp.seek(start + pos + tarfile.BLOCKSIZE)
+                data = fp.read(tarinfo.size).decode("utf-8")
+                index = []
+                for line in data.splitlines():
+                    (offset, name) = line.split(" ", 1)
+                    index.append((name, int(offset)))
+                return index
+            if start == 0 or tail >= self.INDEX_MAX_SEARCH:
+                return None
+            tail *= 4
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self._base is not None:
+            self._base.close()
+        self._tar.close()
+        self._spool.close()
+
+    @staticmethod
+    def _normalize(name):
+        if name.startswith("./"):
+            name = name[2:]
+        return name.rstrip("/")
+
+    def __contains__(self, name):
+        name = self._normalize(name)
+        if name in self._members:
+            return True
+        return (self._base is not None and name not in self._removed and
+                name in self._base)
+
+    def _owns(self, member):
+        name = self._normalize(member.name)
+        return self._members.get(name) is member
+
+    def getmember(self, name):
+        """ return the TarInfo for name, raises KeyError if missing """
+        name = self._normalize(name)
+        if (name not in self._members and self._base is not None and
+                name not in self._removed):
+            return self._base.getmember(name)
+        m = self._members[name]
+        if not isinstance(m, tarfile.TarInfo):
+            # read the header from the offset in the index
+            self._spool.seek(m)
+            m = self._members[name] = tarfile.TarInfo.fromtarfile(self._tar)
+        return m
+
+    def getnames(self):
+        """ return all member names (without prefix) in archive order """
+        names = list(self._order)
+        if self._base is not None:
+            names += [name for name in self._base.getnames()
+                      if name not in self._members and
+                      name not in self._removed]
+        return names
+
+    def getmembers_under(self, dirname):
+        """ return all members below dirname (in archive order) """
+        dirname = self._normalize(dirname) + "/"
+        return [self.getmember(name) for name in self.getnames()
+                if name.startswith(dirname)]
+
+    def get_digest(self, name):
+        """ return a digest of the (uncompressed) content of name """
+        m = self.getmember(name)
+        if not m.isreg():
+            return "%s %s %o" % (m.type, m.linkname, m.mode)
+        sha256 = hashlib.sha256()
+        with self.extractfile(name) as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(data)
+        return "sha256:" + sha256.hexdigest()
+
+    def copy_to_tar(self, name, tar, arcname=None):
+        """ add the (uncompressed) member name to tar """
+        m = self.getmember(name)
+        tarinfo = tarfile.TarInfo(arcname or (self.prefix + name))
+        for attr in ("mode", "uid", "gid", "mtime", "type", "linkname",
+                     "uname", "gname", "devmajor", "devminor"):
+            setattr(tarinfo, attr, getattr(m, attr))
+        if not m.isreg():
+            tar.addfile(tarinfo)
+            return
+        tarinfo.size = int(m.pax_headers.get(PAX_SIZE, m.size))
+        with self.extractfile(name) as f:
+            tar.addfile(tarinfo, f)
+
+    def _extractfile_member(self, member):
+        if isinstance(member, _VirtualTarInfo):
+            return BytesIO(member.data)
+        if self._base is not None and not self._owns(member):
+            return self._base._extractfile_member(member)
+        f = self._tar.extractfile(member)
+        compression = member.pax_headers.get(PAX_COMPRESSION)
+        if f is not None and compression:
+            return _open_member_decompressed(f, compression)
+        return f
+
+    def extractfile(self, name):
+        return self._extractfile_member(self.getmember(name))
+
+    def read(self, name):
+        with self.extractfile(name) as f:
+            return f.read()
+
+    def extract(self, name, targetdir):
+        self.extract_member(self.getmember(name), targetdir)
+
+    def extract_tree(self, name, targetdir):
+        """ extract name and (if its a directory) everything below it """
+        self.extract(name, targetdir)
+        for m in self.getmembers_under(name):
+            self.extract_member(m, targetdir)
+
+    def extract_member(self, member, targetdir, arcname=None):
+        """ extract the given TarInfo, optionally under a different name """
+        if (self._base is not None and not self._owns(member) and
+                not isinstance(member, _VirtualTarInfo)):
+            self._base.extract_member(member, targetdir, arcname)
+            return
+        if arcname is not None:
+            member = copy.copy(member)
+            member.name = arcname
+        if (not member.pax_headers.get(PAX_COMPRESSION) and
+                not isinstance(member, _VirtualTarInfo)):
+            self._tar.extract(member, targetdir)
+            return
+        # members that are compressed on their own need to be written
+        # out by hand
+        path = os.path.join(targetdir, member.name)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        if os.path.lexists(path):
+            os.unlink(path)
+        with self._extractfile_member(member) as src, open(path, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        if os.geteuid() == 0:
+            self._tar.chown(member, path, False)
+        self._tar.chmod(member, path)
+        self._tar.utime(member, path)
+
+
+class TarMemberWriter(object):
+    """ write a tar member incrementally
+
+        The data is written into a spool file (kept in memory while it is
+        small) and added to the tar on close(). This avoids building the
+        whole member as a (potentially huge) string first. The tar can
+        also be given on close() if the member needs to be created before
+        the tar is opened.
+    """
+    SPOOL_MAX_SIZE = 1024 * 1024
+
+    def __init__(self, tar, arcname):
+        self.tar = tar
+        self.arcname = arcname
+        self.sha256 = hashlib.sha256()
+        self._spool = tempfile.SpooledTemporaryFile(
+            max_size=self.SPOOL_MAX_SIZE)
+
+    def write(self, s):
+        data = s.encode("utf-8")
+        self.sha256.update(data)
+        self._spool.write(data)
+
+    def lines(self):
+        """ iterate over the (decoded) lines written so far """
+        end = self._spool.tell()
+        self._spool.seek(0)
+        try:
+            for line in self._spool:
+                yield line.decode("utf-8")
+        finally:
+            self._spool.seek(end)
+
+    def close(self, tar=None):
+        tarinfo = tarfile.TarInfo(self.arcname)
+        tarinfo.size = self._spool.tell()
+        tarinfo.mtime = time.time()
+        self._spool.seek(0)
+        (tar or self.tar).addfile(tarinfo, self._spool)
+        self._spool.close()
+
+
+def _parse_installed_pkgs(f):
+    """ yield (name, version, auto_installed) for the lines of the
+        installed.pkgs file object f
+    """
+    for line in f:
+        line = line.strip().decode('utf-8')
+        if line.startswith("#") or line == "":
+            continue
+        (name, version, auto) = line.split()
+        yield (name, version, auto == "1")
+
+
+def _merge_pkgs(old, new):
+    """ merge the two by name sorted (name, version, auto_installed)
+        iterables and yield (name, old_entry, new_entry), the entry
+        is None if the package is missing on that side
+    """
+    old = iter(old)
+    new = iter(new)
+    a = next(old, None)
+    b = next(new, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and a[0] < b[0]):
+            yield (a[0], a, None)
+            a = next(old, None)
+        elif a is None or b[0] < a[0]:
+            yield (b[0], None, b)
+            b = next(new, None)
+        else:
+            yield (a[0], a, b)
+            a = next(old, None)
+            b = next(new, None)
+
+
+class ClonePackageSet(object):
+    """ the installed packages of a clone file
+
+        The packages are kept sorted by name in parallel lists, names and
+        versions are interned (most versions are shared by many packages)
+        and the auto-installed flags live in a bytearray. Lookups are
+        done by bisection and the set operations (by package name) are
+        linear merges. Iterating yields (name, version, auto_installed).
+    """
+    __slots__ = ("_names", "_versions", "_auto")
+
+    def __init__(self, entries=()):
+        self._names = []
+        self._versions = []
+        self._auto = bytearray()
+        last = None
+        need_sort = False
+        for (name, version, auto) in entries:
+            if last is not None and name <= last:
+                need_sort = True
+            last = name
+            self._names.append(sys.intern(name))
+            self._versions.append(sys.intern(version))
+            self._auto.append(bool(auto))
+        if need_sort:
+            self._sort()
+
+    def _sort(self):
+        # the last entry wins for duplicated names
+        order = {}
+        for i, name in enumerate(self._names):
+            order[name] = i
+        names = sorted(order)
+        self._versions = [self._versions[order[name]] for name in names]
+        self._auto = bytearray(self._auto[order[name]] for name in names)
+        self._names = names
+
+    @classmethod
+    def from_file(cls, f):
+        """ return the ClonePackageSet of the installed.pkgs file object f """
+        return cls(_parse_installed_pkgs(f))
+
+    def __len__(self):
+        return len(self._names)
+
+    def __iter__(self):
+        for i, name in enumerate(self._names):
+            yield (name, self._versions[i], bool(self._auto[i]))
+
+    def _index(self, name):
+        i = bisect.bisect_left(self._names, name)
+        if i < len(self._names) and self._names[i] == name:
+            return i
+        return -1
+
+    def __contains__(self, name):
+        return self._index(name) >= 0
+
+    def __repr__(self):
+        return "<ClonePackageSet with %i packages>" % len(self)
+
+    def get(self, name, default=None):
+        """ return (version, auto_installed) for name """
+        i = self._index(name)
+        if i < 0:
+            return default
+        return (self._versions[i], bool(self._auto[i]))
+
+    def names(self):
+        """ return the sorted list of package names """
+        return list(self._names)
+
+    def auto_count(self):
+        """ return the number of auto-installed packages """
+        return self._auto.count(1)
+
+    @classmethod
+    def _from_sorted(cls, entries):
+        new = cls()
+        for (name, version, auto) in entries:
+            new._names.append(name)
+            new._versions.append(version)
+            new._auto.append(auto)
+        return new
+
+    def __or__(self, other):
+        return self._from_sorted(a or b for name, a, b in
+                                 _merge_pkgs(self, other))
+
+    def __and__(self, other):
+        return self._from_sorted(a for name, a, b in
+                                 _merge_pkgs(self, other)
+                                 if a is not None and b is not None)
+
+    def __sub__(self, other):
+        return self._from_sorted(a for name, a, b in
+                                 _merge_pkgs(self, other) if b is None)
+
+
+class RepackCache(object):
+    """ persistent cache of dpkg-repack'ed debs
+
+        Entries are keyed by package name, version, architecture and the
+        dpkg md5sums of the package files (plus the stat of its conffiles)
+        so that a package that did not change since the last clone does
+        not need to be repacked again. The cache is trimmed to max_size
+        bytes by removing the least recently used entries.
+    """
+    DEFAULT_CACHE_DIR = "/var/cache/apt-clone/debs"
+    DEFAULT_MAX_SIZE = 1024 * 1024 * 1024
+
+    def __init__(self, cachedir=DEFAULT_CACHE_DIR, max_size=DEFAULT_MAX_SIZE):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        if not os.path.exists(cachedir):
+            os.makedirs(cachedir)
+
+    def get_key(self, pkgname, version, arch):
+        """ return the cache key for the installed pkgname """
+        dpkg_info = os.path.join(os.path.dirname(
+            apt_pkg.config.find_file("Dir::State::status")), "info")
+        rootdir = apt_pkg.config.find_dir("Dir", "/")
+        name = pkgname.split(":")[0]
+        key = hashlib.sha256()
+        key.update(("%s %s %s\n" % (name, version, arch)).encode("utf-8"))
+        for base in ("%s:%s" % (name, arch), name):
+            md5sums = os.path.join(dpkg_info, base + ".md5sums")
+            conffiles = os.path.join(dpkg_info, base + ".conffiles")
+            if not os.path.exists(md5sums) and not os.path.exists(conffiles):
+                continue
+            if os.path.exists(md5sums):
+                with open(md5sums, "rb") as fp:
+                    key.update(fp.read())
+            # conffiles are not part of the md5sums but get repacked with
+            # their current content
+            if os.path.exists(conffiles):
+                with open(conffiles) as fp:
+                    for conffile in fp.read().split():
+                        path = os.path.join(rootdir, conffile.lstrip("/"))
+                        try:
+                            st = os.stat(path)
+                        except OSError:
+                            continue
+                        key.update(("%s %i %i\n" % (
+                            conffile, st.st_size, st.st_mtime)).encode("utf-8"))
+            break
+        return key.hexdigest()
+
+    def get(self, key, targetdir):
+        """ copy the cached debs for key into targetdir, returns False if
+            there is no cache entry for key
+        """
+        entry = os.path.join(self.cachedir, key)
+        debs = glob.glob(os.path.join(entry, "*.deb"))
+        if not debs:
+            return False
+        for deb in debs:
+            shutil.copy(deb, targetdir)
+        # mark as recently used
+        os.utime(entry, None)
+        return True
+
+    def put(self, key, debs):
+        """ add the given debs to the cache as entry key """
+        entry = os.path.join(self.cachedir, key)
+        if os.path.exists(entry):
+            return
+        tmp = tempfile.mkdtemp(dir=self.cachedir, prefix=".new-")
+        for deb in debs:
+            shutil.copy(deb, tmp)
+        try:
+            os.rename(tmp, entry)
+        except OSError:
+            # a concurrent run added it already
+            shutil.rmtree(tmp)
+
+    def expire(self):
+        """ remove the least recently used entries until the cache
+            is smaller than max_size
+        """
+        entries = []
+        total = 0
+        for name in os.listdir(self.cachedir):
+            entry = os.path.join(self.cachedir, name)
+            if name.startswith(".") or not os.path.isdir(entry):
+                continue
+            size = sum(os.path.getsize(deb)
+                       for deb in glob.glob(os.path.join(entry, "*.deb")))
+            entries.append((os.path.getmtime(entry), size, entry))
+            total += size
+        for mtime, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry)
+            total -= size
+
+
+class DigestCache(object):
+    """ persistent cache of file md5 digests
+
+        The digests are keyed by path and only reused if the inode, size
+        and mtime of the file are unchanged, so repeated clones only need
+        to read the (conf)files that changed since the last run.
+    """
+    DEFAULT_CACHE_FILE = "/var/cache/apt-clone/digests"
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, cachefile=DEFAULT_CACHE_FILE):
+        self.cachefile = cachefile
+        self._digests = {}
+        self._dirty = False
+        try:
+            with open(cachefile, encoding="utf-8") as fp:
+                for line in fp:
+                    ino, size, mtime, digest, path = line.rstrip(
+                        "\n").split(" ", 4)
+                    self._digests[path] = (
+                        int(ino), int(size), int(mtime), digest)
+        except (IOError, OSError, ValueError):
+            self._digests = {}
+
+    def get_md5(self, path):
+        """ return the md5 hexdigest of path, raises OSError if it
+            can not be read
+        """
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        cached = self._digests.get(path)
+        if cached is not None and cached[:3] == key:
+            return cached[3]
+        digest = _get_md5(path, self.CHUNK_SIZE)
+        self._digests[path] = key + (digest,)
+        self._dirty = True
+        return digest
+
+    def save(self):
+        """ write the cache back (if it changed) """
+        if not self._dirty:
+            return
+        cachedir = os.path.dirname(self.cachefile)
+        try:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            fd, tmp = tempfile.mkstemp(dir=cachedir, prefix=".new-")
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                for path in sorted(self._digests):
+                    fp.write("%i %i %i %s %s\n" % (
+                        self._digests[path] + (path,)))
+            os.rename(tmp, self.cachefile)
+        except (IOError, OSError) as e:
+            logging.warning("can not write digest cache '%s': %s" % (
+                self.cachefile, e))
+            return
+        self._dirty = False
+
+
+class OwnershipIndex(object):
+    """ persistent index of the files below /etc that dpkg owns
+
+        The index remembers the /etc entries of every dpkg info/*.list
+        file together with its mtime and size, on update only the .list
+        files that changed since the last run are read again.
+    """
+    DEFAULT_CACHE_FILE = "/var/cache/apt-clone/etc-owners"
+
+    def __init__(self, cachefile=DEFAULT_CACHE_FILE):
+        self.cachefile = cachefile
+        self._infodir = None
+        # list name -> (mtime_ns, size, [paths])
+        self._lists = {}
+        self._dirty = False
+        if cachefile is None:
+            # in memory only
+            return
+        try:
+            with open(cachefile, encoding="utf-8") as fp:
+                self._infodir = fp.readline().rstrip("\n")
+                paths = None
+                for line in fp:
+                    line = line.rstrip("\n")
+                    if line.startswith("/"):
+                        paths.append(line)
+                        continue
+                    mtime, size, name = line.split(" ", 2)
+                    paths = []
+                    self._lists[name] = (int(mtime), int(size), paths)
+        except (IOError, OSError, ValueError, AttributeError):
+            self._infodir = None
+            self._lists = {}
+
+    def update(self, infodir):
+        """ sync the index with the .list files in the dpkg infodir """
+        if infodir != self._infodir:
+            self._infodir = infodir
+            self._lists = {}
+            self._dirty = True
+        lists = {}
+        try:
+            entries = list(os.scandir(infodir))
+        except OSError:
+            entries = []
+        for entry in entries:
+            if not entry.name.endswith(".list"):
+                continue
+            st = entry.stat()
+            cached = self._lists.get(entry.name)
+            if (cached is not None and
+                    cached[:2] == (st.st_mtime_ns, st.st_size)):
+                lists[entry.name] = cached
+                continue
+            with open(entry.path, encoding="utf-8") as fp:
+                paths = [line.rstrip("\n") for line in fp
+                         if line.startswith("/etc/")]
+            lists[entry.name] = (st.st_mtime_ns, st.st_size, paths)
+            self._dirty = True
+        if len(lists) != len(self._lists):
+            self._dirty = True
+        self._lists = lists
+
+    def owned(self):
+        """ return the set of owned paths below /etc """
+        owned = set()
+        for mtime, size, paths in self._lists.values():
+            owned.update(paths)
+        return owned
+
+    def save(self):
+        """ write the index back (if it changed) """
+        if not self._dirty or self.cachefile is None:
+            return
+        cachedir = os.path.dirname(self.cachefile)
+        try:
+            if not os.path.exists(cachedir):
+                os.makedirs(cachedir)
+            fd, tmp = tempfile.mkstemp(dir=cachedir, prefix=".new-")
+            with os.fdopen(fd, "w", encoding="utf-8") as fp:
+                fp.write("%s\n" % self._infodir)
+                for name in sorted(self._lists):
+                    mtime, size, paths = self._lists[name]
+                    fp.write("%i %i %s\n" % (mtime, size, name))
+                    for path in paths:
+                        fp.write("%s\n" % path)
+            os.rename(tmp, self.cachefile)
+        except (IOError, OSError) as e:
+            logging.warning("can not write ownership index '%s': %s" % (
+                self.cachefile, e))
+            return
+        self._dirty = False
+
+
+class FleetIndex(object):
+    """ sqlite index of the installed (and foreign) packages and the host
+        info of many clone files
+
+        Clone files are only read again if their size or mtime changed
+        (and then only if their content changed too), clones with the
+        same installed packages share one package set in the index.
+        Versions can be compared in queries with the vercmp() sql
+        function that uses apt_pkg.version_compare().
+    """
+    DEFAULT_INDEX_FILE = "/var/cache/apt-clone/fleet.db"
+    # relation -> sql condition on vercmp(installed, wanted), the
+    # deprecated "<" and ">" mean "<=" and ">=" like in debian/control
+    RELATIONS = {
+        "<<": "< 0", "<": "<= 0", "<=": "<= 0", "=": "= 0",
+        ">=": ">= 0", ">": ">= 0", ">>": "> 0",
+    }
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS clones (
+            path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER,
+            digest TEXT, pkgset INTEGER, hostname TEXT, arch TEXT,
+            distro TEXT, kernel TEXT, uname_arch TEXT, date INTEGER);
+        CREATE INDEX IF NOT EXISTS clones_pkgset ON clones (pkgset);
+        CREATE TABLE IF NOT EXISTS pkgsets (
+            id INTEGER PRIMARY KEY, digest TEXT UNIQUE);
+        CREATE TABLE IF NOT EXISTS pkgs (
+            pkgset INTEGER, name TEXT, version TEXT, auto INTEGER);
+        CREATE INDEX IF NOT EXISTS pkgs_name ON pkgs (name);
+        CREATE INDEX IF NOT EXISTS pkgs_pkgset ON pkgs (pkgset);
+        CREATE TABLE IF NOT EXISTS foreign_pkgs (
+            path TEXT, name TEXT, version TEXT, origin TEXT);
+        CREATE INDEX IF NOT EXISTS foreign_pkgs_path ON foreign_pkgs (path);
+        CREATE INDEX IF NOT EXISTS foreign_pkgs_name ON foreign_pkgs (name);
+        CREATE INDEX IF NOT EXISTS foreign_pkgs_origin
+            ON foreign_pkgs (origin);
+    """
+
+    def __init__(self, indexfile=DEFAULT_INDEX_FILE):
+        self.indexfile = indexfile
+        indexdir = os.path.dirname(indexfile)
+        if indexdir and not os.path.exists(indexdir):
+            os.makedirs(indexdir)
+        self._db = sqlite3.connect(indexfile)
+        self._db.create_function("vercmp", 2, apt_pkg.version_compare)
+        self._db.executescript(self.SCHEMA)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _find_statefiles(self, paths):
+        """ yield the given clone files and the ones in the given
+            directories, those are only taken if they are named like
+            save_state() names them
+        """
+        suffixes = tuple(set(suffix for (suffix, level)
+                             in COMPRESSION.values()))
+        for path in paths:
+            if not os.path.isdir(path):
+                yield os.path.abspath(path)
+                continue
+            for f in sorted(_walk_files(path)):
+                name = os.path.basename(f)
+                if (name.endswith(suffixes) and
+                        (".apt-clone.tar" in name or
+                         name.startswith("apt-clone-state-"))):
+                    yield os.path.abspath(f)
+
+    def update(self, paths):
+        """ index the clone files in paths (files or directories that
+            are searched for clone files) and forget the clone files
+            that no longer exist, returns a dict with the number of
+            added, updated, unchanged, removed and failed clone files
+        """
+        stats = dict.fromkeys(
+            ("added", "updated", "unchanged", "removed", "failed"), 0)
+        clone = AptClone()
+        known = dict((path, (size, mtime, digest)) for
+                     (path, size, mtime, digest) in self._db.execute(
+                         "SELECT path, size, mtime, digest FROM clones"))
+        with self._db:
+            for statefile in self._find_statefiles(paths):
+                try:
+                    st = os.stat(statefile)
+                    cached = known.get(statefile)
+                    if cached and cached[:2] == (st.st_size, st.st_mtime_ns):
+                        stats["unchanged"] += 1
+                        continue
+                    digest = _get_file_digest(statefile)
+                    if cached and cached[2] == digest:
+                        self._db.execute(
+                            "UPDATE clones SET size = ?, mtime = ? "
+                            "WHERE path = ?",
+                            (st.st_size, st.st_mtime_ns, statefile))
+                        stats["unchanged"] += 1
+                        continue
+                    with StateArchive(statefile) as archive:
+                        self._add(clone, statefile, archive, st, digest)
+                except Exception as e:
+                    logging.warning("can not index '%s': %s" % (statefile, e))
+                    stats["failed"] += 1
+                    continue
+                stats["updated" if cached else "added"] += 1
+            for path in known:
+                if not os.path.exists(path):
+                    self._remove(path)
+                    stats["removed"] += 1
+            # forget the package sets no clone uses anymore
+            self._db.execute(
+                "DELETE FROM pkgs WHERE pkgset NOT IN "
+                "(SELECT pkgset FROM clones)")
+            self._db.execute(
+                "DELETE FROM pkgsets WHERE id NOT IN "
+                "(SELECT pkgset FROM clones)")
+        return stats
+
+    def _remove(self, path):
+        self._db.execute("DELETE FROM clones WHERE path = ?", (path,))
+        self._db.execute("DELETE FROM foreign_pkgs WHERE path = ?", (path,))
+
+    def _get_pkgset(self, pkgs):
+        sha256 = hashlib.sha256()
+        for entry in pkgs:
+            sha256.update(("%s %s %i\n" % entry).encode("utf-8"))
+        digest = "sha256:" + sha256.hexdigest()
+        row = self._db.execute(
+            "SELECT id FROM pkgsets WHERE digest = ?", (digest,)).fetchone()
+        if row is not None:
+            return row[0]
+        pkgset = self._db.execute(
+            "INSERT INTO pkgsets (digest) VALUES (?)", (digest,)).lastrowid
+        self._db.executemany(
+            "INSERT INTO pkgs (pkgset, name, version, auto) "
+            "VALUES (?, ?, ?, ?)",
+            ((pkgset, name, version, int(auto))
+             for (name, version, auto) in pkgs))
+        return pkgset
+
+    def _add(self, clone, statefile, archive, st, digest):
+        # read everything first so that a broken clone file adds nothing
+        pkgs = clone._get_package_set(archive)
+        foreign = []
+        if "var/lib/apt-clone/foreign.pkgs" in archive:
+            with archive.extractfile("var/lib/apt-clone/foreign.pkgs") as f:
+                foreign = [line.decode("utf-8").strip().split(None, 2)
+                           for line in f if line.strip()]
+        info = {"hostname": "unknown", "arch": "unknown",
+                "distro": None, "kernel": None, "uname_arch": None,
+                "date": int(archive.getmember(
+                    "var/lib/apt-clone/installed.pkgs").mtime)}
+        if "var/lib/apt-clone/uname" in archive:
+            section = apt_pkg.TagSection(
+                archive.read("var/lib/apt-clone/uname"))
+            for key in ("hostname", "arch", "kernel", "uname_arch"):
+                info[key] = section.get(key, info[key])
+        if "var/lib/apt-clone/manifest" in archive:
+            section = apt_pkg.TagSection(
+                archive.read("var/lib/apt-clone/manifest"))
+            info["distro"] = section.get("Distro")
+            info["date"] = int(section.get("Date", "0")) or info["date"]
+        if info["distro"] is None and "etc/apt/sources.list" in archive:
+            info["distro"] = clone._get_info_distro(archive)
+        pkgset = self._get_pkgset(pkgs)
+        self._remove(statefile)
+        self._db.execute(
+            "INSERT INTO clones (path, size, mtime, digest, pkgset, "
+            "hostname, arch, distro, kernel, uname_arch, date) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (statefile, st.st_size, st.st_mtime_ns, digest, pkgset,
+             info["hostname"], info["arch"], info["distro"] or "unknown",
+             info["kernel"], info["uname_arch"], info["date"]))
+        self._db.executemany(
+            "INSERT INTO foreign_pkgs (path, name, version, origin) "
+            "VALUES (?, ?, ?, ?)",
+            ((statefile, name, version, origin)
+             for (name, version, origin) in foreign))
+
+    def query(self, package=None, relation=None, version=None,
+              foreign=False, origin=None, hostname=None, arch=None,
+              kernel=None, distro=None):
+        """ return a list of dicts for the matching clones
+
+            Without package, foreign and origin there is one dict per
+            clone with its host info. With package (a name or a glob
+            pattern) the installed package (and version) is added, with
+            foreign=True or an origin the packages from foreign.pkgs are
+            searched instead. relation and version ("<<", "<=", "=", ">="
+            or ">>" and a version) limit the installed versions. The host
+            info arguments are glob patterns as well.
+        """
+        columns = ["c.path", "c.hostname", "c.arch", "c.distro", "c.kernel",
+                   "c.uname_arch", "c.date"]
+        where = []
+        values = []
+        if foreign or origin is not None:
+            table = "foreign_pkgs p JOIN clones c ON c.path = p.path"
+            columns += ["p.name", "p.version", "p.origin"]
+            if origin is not None:
+                where.append("p.origin GLOB ?")
+                values.append(origin)
+        elif package is not None:
+            table = "pkgs p JOIN clones c ON c.pkgset = p.pkgset"
+            columns += ["p.name", "p.version", "p.auto"]
+        else:
+            table = "clones c"
+        if package is not None:
+            # a plain name can use the index
+            if set("*?[") & set(package):
+                where.append("p.name GLOB ?")
+            else:
+                where.append("p.name = ?")
+            values.append(package)
+        if version is not None:
+            if table == "clones c":
+                raise ValueError("a version needs a package")
+            if relation not in self.RELATIONS:
+                raise ValueError("unknown relation '%s'" % relation)
+            where.append("vercmp(p.version, ?) %s" % self.RELATIONS[relation])
+            values.append(version)
+        for (column, pattern) in (("hostname", hostname), ("arch", arch),
+                                  ("kernel", kernel), ("distro", distro)):
+            if pattern is not None:
+                where.append("c.%s GLOB ?" % column)
+                values.append(pattern)
+        sql = "SELECT %s FROM %s" % (", ".join(columns), table)
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY c.hostname, c.path"
+        if table != "clones c":
+            sql += ", p.name"
+        names = [column.split(".")[1] for column in columns]
+        names = ["package" if name == "name" else name for name in names]
+        result = []
+        for row in self._db.execute(sql, values):
+            entry = dict(zip(names, row))
+            if "auto" in entry:
+                entry["auto"] = bool(entry["auto"])
+            result.append(entry)
+        return result
+
+
+def _walk_files(topdir):
+    """ yield the paths of all non-directories below topdir, symlinks
+        to directories are reported but not followed
+    """
+    dirs = [topdir]
+    while dirs:
+        try:
+            entries = os.scandir(dirs.pop())
+        except OSError:
+            continue
+        with entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.path)
+                else:
+                    yield entry.path
+
+
+def _link_or_copy(src, dst):
+    """ hardlink src to dst, or reflink/copy it if that is not possible
+        (e.g. across filesystems)
+    """
+    try:
+        os.link(src, dst)
+        return
+    except OSError:
+        pass
+    if subprocess.call(["cp", "--reflink=auto", "--preserve=timestamps",
+                        src, dst], stderr=subprocess.DEVNULL) != 0:
+        shutil.copy2(src, dst)
+
+
+def _seed_lists(listsdir, targetdir):
+    """ seed the apt lists dir of the root targetdir with the lists in
+        listsdir so that no apt update is needed
+    """
+    target_lists = os.path.join(targetdir, "var", "lib", "apt", "lists")
+    os.makedirs(os.path.join(target_lists, "partial"), exist_ok=True)
+    for entry in os.scandir(listsdir):
+        if entry.name == "lock" or not entry.is_file(follow_symlinks=False):
+            continue
+        _link_or_copy(entry.path, os.path.join(target_lists, entry.name))
+
+
+# the fields of a Packages file stanza needed for the availability check
+PACKAGES_FIELDS_RE = re.compile(
+    rb"^(Package|Version|Architecture): *(\S+)", re.MULTILINE)
+
+
+def _find_packages_files(topdir):
+    """ return the Packages index files below topdir, the uncompressed
+        one is preferred if a index is there in more than one form
+    """
+    found = {}
+    for path in _walk_files(topdir):
+        base, ext = os.path.splitext(path)
+        if os.path.basename(path) == "Packages":
+            found[path] = path
+        elif os.path.basename(base) == "Packages" and ext in (".gz", ".xz"):
+            found.setdefault(base, path)
+    return sorted(found.values())
+
+
+def _index_packages_file(path, native_arch, available):
+    """ add "name version" and "name:arch version" (as bytes) of every
+        package in the Packages file at path to the set available
+    """
+    if path.endswith(".gz"):
+        with gzip.open(path) as fp:
+            data = fp.read()
+    elif path.endswith(".xz"):
+        with lzma.open(path) as fp:
+            data = fp.read()
+    else:
+        with open(path, "rb") as fp:
+            if os.fstat(fp.fileno()).st_size == 0:
+                return
+            data = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+    native_arch = native_arch.encode("utf-8")
+    name = version = arch = None
+    for m in PACKAGES_FIELDS_RE.finditer(data):
+        field, value = m.groups()
+        if field == b"Package":
+            if name is not None and version is not None:
+                _add_available(available, name, version, arch, native_arch)
+            name = value
+            version = arch = None
+        elif field == b"Version":
+            version = value
+        else:
+            arch = value
+    if name is not None and version is not None:
+        _add_available(available, name, version, arch, native_arch)
+    if isinstance(data, mmap.mmap):
+        data.close()
+
+
+def _add_available(available, name, version, arch, native_arch):
+    if arch in (None, b"all", native_arch):
+        available.add(name + b" " + version)
+    if arch is not None:
+        available.add(name + b":" + arch + b" " + version)
+
+
+# apt_pkg.config is process global and the operations below point it
+# to the root they work on (Dir, Dir::State::status, Dir::Bin, ...)
+_apt_config_lock = threading.RLock()
+
+
+def _snapshot_apt_config():
+    """ return the content of apt_pkg.config as a list of (key, value)
+        in tree order, list items use the "Foo::" key of their list
+    """
+    config = apt_pkg.config
+    snapshot = []
+    # list items have no name to find() them with, their value is
+    # at their position among the children of the list in value_list()
+    children = {}
+    for key in config.keys():
+        parent, _, name = key.rpartition("::")
+        pos = children.setdefault(parent, [0, None])
+        if name:
+            value = config.find(key)
+        else:
+            if pos[1] is None:
+                pos[1] = config.value_list(parent)
+            value = pos[1][pos[0]]
+        pos[0] += 1
+        snapshot.append((key, value))
+    return snapshot
+
+
+def _restore_apt_config(snapshot):
+    """ reset apt_pkg.config to a snapshot of _snapshot_apt_config() """
+    config = apt_pkg.config
+    for key in config.list():
+        config.clear(key)
+    for key, value in snapshot:
+        # "Foo::" entries append to the list "Foo"
+        config.set(key, value)
+
+
+@contextmanager
+def _apt_config_context():
+    """ run the block with exclusive access to apt_pkg.config and
+        restore its previous content afterwards
+    """
+    with _apt_config_lock:
+        snapshot = _snapshot_apt_config()
+        try:
+            yield
+        finally:
+            _restore_apt_config(snapshot)
+
+
+def _with_apt_config(func):
+    """ decorator to run a AptClone operation in _apt_config_context() """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        with _apt_config_context():
+            return func(*args, **kwargs)
+    return wrapper
+
+
+def _pool(processes, **kwargs):
+    """ return a multiprocessing pool whose workers start with the
+        current apt_pkg.config
+
+        The workers come from a forkserver, a plain fork() could copy
+        _apt_config_lock while another thread holds it.
+    """
+    with _apt_config_lock:
+        snapshot = _snapshot_apt_config()
+    context = multiprocessing.get_context("forkserver")
+    return context.Pool(processes, initializer=_restore_apt_config,
+                        initargs=(snapshot,), **kwargs)
+
+
 class AptClone(object):
     """ clone the package selection/installation of a existing system
         using the information that apt provides
 
         If dpkg-repack is installed, it will be used to generate debs
         for the obsolete ones.
+
+        The operations that point apt_pkg.config to a root directory
+        hold a process wide lock and restore the previous configuration
+        when they are done, so instances can be used from several
+        threads but those operations run one after the other. Use
+        clone_many() or simulate_restore_batch(jobs=N) for real
+        parallelism, they run in separate processes.
     """
     CLONE_FILENAME = "apt-clone-state-%s.tar.gz" % os.uname()[1]
 
-    TARPREFIX = "./"
-
     def __init__(self, fetch_progress=None, install_progress=None,
                  cache_cls=None):
         self.not_downloadable = set()
         self.version_mismatch = set()
+        self.repack_failed = {}
+        # pkgname -> (version, arch) of the not downloadable packages
+        self._not_downloadable_versions = {}
         self.commands = LowLevelCommands()
         # fetch
         if fetch_progress:
@@ -125,17 +1571,86 @@ class AptClone(object):
             self._cache_cls = apt.Cache
 
     # save
+    @_with_apt_config
     def save_state(self, sourcedir, target,
                    with_dpkg_repack=False, with_dpkg_status=False,
-                   scrub_sources=False, extra_files=None):
+                   scrub_sources=False, extra_files=None, fast=False,
+                   jobs=1, repack_cache=None, compression="gzip",
+                   compression_level=None, compression_threads=1,
+                   seekable=False, base=None,
+                   with_modified_conffiles=False, digest_cache=None,
+                   with_unowned_files=False, ownership_index=None,
+                   with_lists=False):
         """ save the current system state (installed pacakges, enabled
             repositories ...) into the apt-state.tar.gz file in targetdir
+
+            With fast=True the installed packages are read directly from
+            the dpkg status and extended_states files without opening a
+            apt cache. The not-downloadable/foreign package analysis is
+            only done then if it is needed for with_dpkg_repack.
+
+            The dpkg-repack calls are run on up to "jobs" packages in
+            parallel. If a RepackCache is given as repack_cache unchanged
+            packages are taken from there instead of being repacked.
+
+            The state file is compressed with "compression" (one of gzip,
+            zstd, xz or none) using the given level and threads. With
+            seekable=True the tar itself stays uncompressed (and gets a
+            .tar suffix), its members are compressed one by one (already
+            compressed payloads like debs are stored as they are) and
+            indexed so that single members can be read without
+            decompressing the whole file.
+
+            If a base clone file is given only the difference to it is
+            stored, the base must be kept next to the delta clone file.
+
+            With with_modified_conffiles=True the conffiles that differ
+            from the packaged version are included, their digests are
+            reused from the optional DigestCache if they did not change.
+
+            With with_unowned_files=True the files below /etc that no
+            package owns are included (for reference, they are not
+            restored), the dpkg ownership is read from the optional
+            OwnershipIndex.
+
+            With with_lists=True the apt package lists are included so
+            that a restore can skip downloading them again.
+
+            Returns the path of the written clone file.
         """
+        suffix = COMPRESSION[compression][0]
+        if seekable:
+            suffix = COMPRESSION["none"][0]
         if os.path.isdir(target):
-            target = os.path.join(target, self.CLONE_FILENAME)
+            target = os.path.join(
+                target,
+                self.CLONE_FILENAME[:-len(".tar.gz")] + suffix)
         else:
-            if not target.endswith(".tar.gz"):
-                target += ".apt-clone.tar.gz"
+            if not target.endswith(suffix):
+                target += ".apt-clone" + suffix
+
+        if base is not None:
+            # write a full clone first and store the difference to base
+            fd, full = tempfile.mkstemp(
+                suffix=COMPRESSION["none"][0],
+                dir=os.path.dirname(os.path.abspath(target)))
+            os.close(fd)
+            try:
+                self.save_state(
+                    sourcedir, full, with_dpkg_repack, with_dpkg_status,
+                    scrub_sources, extra_files, fast, jobs, repack_cache,
+                    compression="none",
+                    with_modified_conffiles=with_modified_conffiles,
+                    digest_cache=digest_cache,
+                    with_unowned_files=with_unowned_files,
+                    ownership_index=ownership_index,
+                    with_lists=with_lists)
+                self._write_delta(full, base, target, compression,
+                                  compression_level, compression_threads,
+                                  seekable)
+            finally:
+                os.remove(full)
+            return target
 
         if sourcedir != '/':
             apt_pkg.init_config()
@@ -144,18 +1659,128 @@ class AptClone(object):
                                os.path.join(sourcedir, 'var/lib/dpkg/status'))
             apt_pkg.init_system()
 
-        with tarfile.open(name=target, mode="w:gz") as tar:
+        # the package lists are needed for the manifest, that needs to be
+        # the first member
+        installed, foreign = self._get_state_installed_pkgs(
+            sourcedir, fast=fast, analyse=with_dpkg_repack)
+        fp, tar = self._open_tar_for_writing(
+            target, compression, compression_level, compression_threads,
+            seekable)
+        with fp, tar:
+            self._write_manifest(tar, installed)
             self._write_uname(tar)
-            self._write_state_installed_pkgs(sourcedir, tar)
+            installed.close(tar)
+            foreign.close(tar)
             self._write_state_auto_installed(tar)
             self._write_state_sources_list(tar, scrub_sources)
             self._write_state_apt_preferences(tar)
             self._write_state_apt_keyring(tar)
             self._write_state_extra_files(extra_files, tar)
+            if with_modified_conffiles:
+                self._write_modified_files_from_etc(
+                    tar, sourcedir, jobs, digest_cache)
+            if with_unowned_files:
+                self._write_unowned_files_from_etc(
+                    tar, sourcedir, ownership_index)
+            if with_lists:
+                self._write_state_lists(tar)
             if with_dpkg_status:
                 self._write_state_dpkg_status(tar)
             if with_dpkg_repack:
-                self._dpkg_repack(tar)
+                self._dpkg_repack(tar, jobs, repack_cache)
+        return target
+
+    def _open_tar_for_writing(self, target, compression="gzip", level=None,
+                              threads=1, member_compression=False):
+        """ return the (file, tarfile) to write a clone file to """
+        if member_compression:
+            fp = _open_compressed(target, "none")
+            tar = MemberCompressedTarFile.open(
+                fileobj=fp, mode="w|", format=tarfile.PAX_FORMAT,
+                pax_headers={PAX_INDEXED: "1"})
+            if compression != "none":
+                tar.member_compression = compression
+            else:
+                tar.member_compression = None
+            tar.member_compression_level = level
+        else:
+            fp = _open_compressed(target, compression, level, threads)
+            tar = tarfile.open(fileobj=fp, mode="w|")
+        return fp, tar
+
+    # delta clones
+    def _write_delta(self, fullfile, basefile, target, compression="gzip",
+                     compression_level=None, compression_threads=1,
+                     seekable=False):
+        """ write the difference of the clone fullfile to the clone
+            basefile as a delta clone file to target, with seekable=True
+            its members are compressed one by one like in save_state()
+        """
+        skip = set(["var/lib/apt-clone/manifest",
+                    "var/lib/apt-clone/installed.pkgs",
+                    MemberCompressedTarFile.INDEX_NAME[2:],
+                    StateArchive.DELTA_PKGS,
+                    StateArchive.DELTA_REMOVED])
+        fp, tar = self._open_tar_for_writing(
+            target, compression, compression_level, compression_threads,
+            seekable)
+        with StateArchive(fullfile) as full, \
+                StateArchive(basefile) as base, fp, tar:
+            # the manifest of the full clone plus where to find the base
+            manifest = TarMemberWriter(tar, "./var/lib/apt-clone/manifest")
+            manifest.write(full.read("var/lib/apt-clone/manifest").decode(
+                "utf-8"))
+            manifest.write("Base: %s\nBase-Digest: %s\n" % (
+                os.path.relpath(os.path.abspath(basefile),
+                                os.path.dirname(os.path.abspath(target))),
+                _get_file_digest(basefile)))
+            manifest.close()
+            # package additions, removals and changes
+            delta = TarMemberWriter(tar, "./" + StateArchive.DELTA_PKGS)
+            for name, a, b in _merge_pkgs(self._get_package_set(base),
+                                          self._get_package_set(full)):
+                if b is None:
+                    delta.write("- %s\n" % name)
+                elif a != b:
+                    delta.write("+ %s %s %i\n" % b)
+            delta.close()
+            # changed and removed files
+            for name in full.getnames():
+                if name in skip:
+                    continue
+                if (name in base and
+                        base.get_digest(name) == full.get_digest(name)):
+                    continue
+                full.copy_to_tar(name, tar, "./" + name)
+            removed = TarMemberWriter(tar, "./" + StateArchive.DELTA_REMOVED)
+            for name in base.getnames():
+                if name not in skip and name not in full:
+                    removed.write("%s\n" % name)
+            removed.close()
+
+    def compact(self, statefile, target, compression="gzip",
+                compression_level=None, compression_threads=1):
+        """ fold the delta clone file statefile (and its chain of base
+            clone files) into the full clone file target
+        """
+        skip = set([MemberCompressedTarFile.INDEX_NAME[2:],
+                    StateArchive.DELTA_PKGS,
+                    StateArchive.DELTA_REMOVED])
+        fp, tar = self._open_tar_for_writing(
+            target, compression, compression_level, compression_threads)
+        with self._open_state(statefile) as archive, fp, tar:
+            for name in archive.getnames():
+                if name in skip:
+                    continue
+                if name != "var/lib/apt-clone/manifest":
+                    archive.copy_to_tar(name, tar, "./" + name)
+                    continue
+                # the full clone does not need a base
+                manifest = TarMemberWriter(tar, "./" + name)
+                for line in archive.read(name).decode("utf-8").splitlines():
+                    if not line.startswith("Base"):
+                        manifest.write(line + "\n")
+                manifest.close()
 
     def _get_host_info_dict(self):
         # not really uname
@@ -183,18 +1808,136 @@ class AptClone(object):
             for f in glob.glob(p):
                 tar.add(f, arcname="./extra-files"+f)
                 
-    def _write_state_installed_pkgs(self, sourcedir, tar):
+    def _get_installed_pkgs_from_dpkg_status(self, dpkg_status=None,
+                                             extended_states=None):
+        """ return a sorted list of (name, version, auto_installed) for all
+            installed packages by reading the dpkg status and the apt
+            extended_states directly (no apt cache is needed for this)
+        """
+        native_arch = apt_pkg.config.find("APT::Architecture")
+        # auto-installed info
+        auto = set()
+        if extended_states is None:
+            extended_states = apt_pkg.config.find_file(
+                "Dir::State::extended_states")
+        if os.path.exists(extended_states):
+            with open(extended_states) as fp:
+                for section in apt_pkg.TagFile(fp):
+                    if section.get("Auto-Installed", "0") != "1":
+                        continue
+                    auto.add((section["Package"],
+                              section.get("Architecture", native_arch)))
+        # installed packages
+        installed = []
+        if dpkg_status is None:
+            dpkg_status = apt_pkg.config.find_file("Dir::State::status")
+        with open(dpkg_status) as fp:
+            for section in apt_pkg.TagFile(fp):
+                status = section.get("Status", "").split()
+                if (len(status) != 3 or
+                        status[2] in ("not-installed", "config-files")):
+                    continue
+                name = section["Package"]
+                arch = section.get("Architecture", native_arch)
+                if arch == "all":
+                    arch = native_arch
+                auto_installed = (name, arch) in auto
+                if arch != native_arch:
+                    name = "%s:%s" % (name, arch)
+                installed.append(
+                    (name, section["Version"], auto_installed))
+        installed.sort()
+        return installed
+
+    def _get_state_installed_pkgs(self, sourcedir, fast=False, analyse=True):
+        """ return TarMemberWriters with the installed.pkgs and
+            foreign.pkgs data (to be added to the tar with close(tar))
+        """
+        installed = TarMemberWriter(None, "./var/lib/apt-clone/installed.pkgs")
+        foreign = TarMemberWriter(None, "./var/lib/apt-clone/foreign.pkgs")
+        if fast:
+            for (name, version, auto) in \
+                    self._get_installed_pkgs_from_dpkg_status():
+                installed.write("%s %s %s\n" % (name, version, int(auto)))
+            # the optional second phase that needs a full cache
+            if analyse:
+                self._analyse_installed_pkgs(sourcedir, None, foreign)
+        else:
+            self._analyse_installed_pkgs(sourcedir, installed, foreign)
+        return installed, foreign
+
+    def _write_state_installed_pkgs(self, sourcedir, tar, fast=False,
+                                    analyse=True):
+        installed, foreign = self._get_state_installed_pkgs(
+            sourcedir, fast, analyse)
+        # store the installed.pkgs and the foreign packages
+        installed.close(tar)
+        foreign.close(tar)
+
+    def _get_manifest_dict(self, installed):
+        """ return the summary of the clone that goes into the manifest,
+            installed is the TarMemberWriter with the installed.pkgs
+        """
+        count = autoinstalled = 0
+        meta = []
+        for line in installed.lines():
+            (name, version, auto) = line.split()
+            count += 1
+            if int(auto):
+                autoinstalled += 1
+            # FIXME: this is a bad way to figure out about the
+            # meta-packages
+            if name.endswith("-desktop"):
+                meta.append(name)
+        distro = None
+        sources_list = apt_pkg.config.find_file("Dir::Etc::sourcelist")
+        if os.path.exists(sources_list):
+            with open(sources_list, "rb") as fp:
+                distro = self._get_distro_from_sources_list(fp)
+        host_info = self._get_host_info_dict()
+        return { 'hostname' : host_info['hostname'],
+                 'arch' : host_info['arch'],
+                 'distro' : distro or "unknown",
+                 'meta' : ", ".join(meta),
+                 'installed' : count,
+                 'autoinstalled' : autoinstalled,
+                 'date' : int(time.time()),
+                 'digest' : "sha256:" + installed.sha256.hexdigest(),
+               }
+
+    def _write_manifest(self, tar, installed):
+        manifest = TarMemberWriter(tar, "./var/lib/apt-clone/manifest")
+        manifest.write("Format: 1\n"
+                       "Hostname: %(hostname)s\n"
+                       "Arch: %(arch)s\n"
+                       "Distro: %(distro)s\n"
+                       "Meta: %(meta)s\n"
+                       "Installed: %(installed)s\n"
+                       "Auto-Installed: %(autoinstalled)s\n"
+                       "Date: %(date)s\n"
+                       "Packages-Digest: %(digest)s\n" %
+                       self._get_manifest_dict(installed))
+        manifest.close()
+
+    def _analyse_installed_pkgs(self, sourcedir, installed, foreign):
+        """ go over the installed packages in the apt cache, find the
+            not-downloadable and foreign ones and write the package
+            records to the installed/foreign writers (installed can be
+            None if only the analysis is wanted)
+        """
         cache = self._cache_cls(rootdir=sourcedir)
-        s = ""
-        foreign = ""
         distro_id = lsb_release.get_distro_information()['ID']
         for pkg in cache:
             if pkg.is_installed:
                 # a version identifies the pacakge
-                s += "%s %s %s\n" % (
-                    pkg.name, pkg.installed.version, int(pkg.is_auto_installed))
+                if installed is not None:
+                    installed.write("%s %s %s\n" % (
+                        pkg.name, pkg.installed.version,
+                        int(pkg.is_auto_installed)))
                 if not pkg.candidate or not pkg.candidate.downloadable:
                     self.not_downloadable.add(pkg.name)
+                    self._not_downloadable_versions[pkg.name] = (
+                        pkg.installed.version, pkg.installed.architecture)
                 elif not (pkg.installed.downloadable and
                           pkg.candidate.downloadable):
                     self.version_mismatch.add(pkg.name)
@@ -202,22 +1945,10 @@ class AptClone(object):
                     if o.archive == "now" and o.origin == "":
                         continue
                     if o.origin != distro_id:
-                        foreign += "%s %s %s\n" % (
+                        foreign.write("%s %s %s\n" % (
                             pkg.name, pkg.installed.version,
-                            o.origin if o.origin != "" else "unknown")
+                            o.origin if o.origin != "" else "unknown"))
                     break
-        # store the installed.pkgs
-        tarinfo = tarfile.TarInfo("./var/lib/apt-clone/installed.pkgs")
-        s = s.encode('utf-8')
-        tarinfo.size = len(s)
-        tarinfo.mtime = time.time()
-        tar.addfile(tarinfo, BytesIO(s))
-        # store the foreign packages
-        tarinfo = tarfile.TarInfo("./var/lib/apt-clone/foreign.pkgs")
-        foreign = foreign.encode('utf-8')
-        tarinfo.size = len(foreign)
-        tarinfo.mtime = time.time()
-        tar.addfile(tarinfo, BytesIO(foreign))
 
     def _write_state_dpkg_status(self, tar):
         # store dpkg-status, this is not strictly needed as installed.pkgs
@@ -226,6 +1957,16 @@ class AptClone(object):
         dpkg_status = apt_pkg.config.find_file("dir::state::status")
         tar.add(dpkg_status, arcname="./var/lib/apt-clone/dpkg-status")
 
+    def _write_state_lists(self, tar):
+        listsdir = apt_pkg.config.find_dir("Dir::State::lists")
+        if not os.path.isdir(listsdir):
+            return
+        for entry in sorted(os.scandir(listsdir), key=lambda e: e.name):
+            if entry.name == "lock" or not entry.is_file(follow_symlinks=False):
+                continue
+            tar.add(entry.path,
+                    arcname="./var/lib/apt-clone/lists/" + entry.name)
+
     def _write_state_auto_installed(self, tar):
         extended_states = apt_pkg.config.find_file(
             "Dir::State::extended_states")
@@ -290,100 +2031,250 @@ class AptClone(object):
         else:
             tar.add(sources, arcname=arcname)
 
-    def _write_modified_files_from_etc(self, tar):
-        #etcdir = os.path.join(apt_pkg.config.get("Dir"), "etc")
-        pass
+    def _write_modified_files_from_etc(self, tar, sourcedir="/", jobs=1,
+                                       digest_cache=None):
+        """ add the modified conffiles and the list of the removed
+            ones to tar
+        """
+        sourcedir = sourcedir.rstrip("/")
+        modified = self._find_modified_conffiles(
+            sourcedir, jobs, digest_cache,
+            apt_pkg.config.find_file("Dir::State::status"))
+        removed = TarMemberWriter(
+            tar, "./var/lib/apt-clone/removed-conffiles")
+        for path in sorted(modified):
+            name = path[len(sourcedir):]
+            if os.path.lexists(path):
+                try:
+                    tar.add(path, arcname="./modified-conffiles"+name)
+                except (IOError, OSError) as e:
+                    logging.warning("can not add modified conffile '%s': %s"
+                                    % (path, e))
+            else:
+                removed.write("%s\n" % name)
+        removed.close()
+
+    def _write_unowned_files_from_etc(self, tar, sourcedir="/",
+                                      ownership_index=None):
+        """ add the files below /etc that no package owns to tar """
+        sourcedir = sourcedir.rstrip("/")
+        unowned = self._find_unowned_in_etc(sourcedir, ownership_index)
+        for name in sorted(unowned):
+            path = sourcedir+name
+            if not (os.path.islink(path) or os.path.isfile(path)):
+                continue
+            try:
+                tar.add(path, arcname="./unowned-files"+name)
+            except (IOError, OSError) as e:
+                logging.warning("can not add unowned file '%s': %s" % (
+                    path, e))
+
+    def _repack_deb_in_workdir(self, pkgname, workdir, repack_cache=None):
+        """ dpkg-repack pkgname into its own workdir and return None on
+            success or a string describing the failure
+        """
+        os.makedirs(workdir)
+        key = None
+        if (repack_cache is not None and
+                pkgname in self._not_downloadable_versions):
+            version, arch = self._not_downloadable_versions[pkgname]
+            key = repack_cache.get_key(pkgname, version, arch)
+            if repack_cache.get(key, workdir):
+                logging.debug("using cached deb for %s" % pkgname)
+                return None
+        res = self.commands.repack_deb(pkgname, workdir)
+        if res is None:
+            return "fakeroot not available"
+        if not res:
+            return "dpkg-repack failed"
+        debs = glob.glob(os.path.join(workdir, "*.deb"))
+        if not debs:
+            return "no deb created"
+        if key is not None:
+            repack_cache.put(key, debs)
+        return None
 
-    def _dpkg_repack(self, tar):
+    def _dpkg_repack(self, tar, jobs=1, repack_cache=None):
         tdir = tempfile.mkdtemp()
-        for pkgname in self.not_downloadable:
-            self.commands.repack_deb(pkgname, tdir)
-        tar.add(tdir, arcname="./var/lib/apt-clone/debs")
+        debsdir = os.path.join(tdir, "debs")
+        os.makedirs(debsdir)
+        pkgnames = sorted(self.not_downloadable)
+        workdirs = [os.path.join(tdir, "work", "%i" % i)
+                    for i in range(len(pkgnames))]
+        # the repacks are independent subprocesses, so threads are enough
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as pool:
+            results = list(pool.map(
+                self._repack_deb_in_workdir, pkgnames, workdirs,
+                [repack_cache] * len(pkgnames)))
+        if repack_cache is not None:
+            repack_cache.expire()
+        # collect the results in a stable order
+        for pkgname, workdir, error in zip(pkgnames, workdirs, results):
+            if error:
+                logging.warning("can not repack %s (%s)" % (pkgname, error))
+                self.repack_failed[pkgname] = error
+                continue
+            for deb in sorted(glob.glob(os.path.join(workdir, "*.deb"))):
+                os.rename(deb, os.path.join(debsdir, os.path.basename(deb)))
+        tar.add(debsdir, arcname="./var/lib/apt-clone/debs")
+        # record what could not be repacked
+        failed = TarMemberWriter(tar, "./var/lib/apt-clone/repack-failed.pkgs")
+        for pkgname in sorted(self.repack_failed):
+            failed.write("%s %s\n" % (pkgname, self.repack_failed[pkgname]))
+        failed.close()
         shutil.rmtree(tdir)
-        #print(tdir)
 
-    # detect prefix
-    def _detect_tarprefix(self, tar):
-        #print(tar.getnames())
-        if tar.getnames()[-1].startswith("./"):
-            self.TARPREFIX = "./"
+    # archive access
+    @contextmanager
+    def _open_state(self, statefile):
+        """ yield a StateArchive for statefile, statefile can be a path
+            or an already opened StateArchive (that is not closed then)
+        """
+        if isinstance(statefile, StateArchive):
+            yield statefile
         else:
-            self.TARPREFIX = ""
+            with StateArchive(statefile) as archive:
+                yield archive
 
     # info
-    def _get_info_distro(self, statefile):
-        with tarfile.open(statefile) as tar:
-            self._detect_tarprefix(tar)
-            # guess distro infos
-            f = tar.extractfile(self.TARPREFIX+"etc/apt/sources.list")
-            for line in f.readlines():
-                line = line.decode("utf-8")
-                if line.startswith("#") or line.strip() == "":
+    def _get_distro_from_sources_list(self, f):
+        # guess distro infos
+        for line in f.readlines():
+            line = line.decode("utf-8")
+            if line.startswith("#") or line.strip() == "":
+                continue
+            l = line.split()
+            if len(l) > 2 and not l[2].endswith("/"):
+                return l[2]
+        return None
+
+    def _get_info_distro(self, archive):
+        return self._get_distro_from_sources_list(
+            archive.extractfile("etc/apt/sources.list"))
+
+    def _get_info_dict_from_manifest(self, data):
+        section = apt_pkg.TagSection(data)
+        return { 'hostname' : section.get("Hostname", "unknown"),
+                 'distro' : section.get("Distro", "unknown"),
+                 'meta' : section.get("Meta", ""),
+                 'installed' : int(section.get("Installed", "0")),
+                 'autoinstalled' : int(section.get("Auto-Installed", "0")),
+                 'date' : int(section.get("Date", "0")),
+                 'arch' : section.get("Arch", "unknown"),
+               }
+
+    def _read_manifest(self, statefile):
+        """ read only the manifest at the start of statefile, returns
+            None for clone files that have no manifest
+        """
+        with _open_decompressed(statefile) as fp, \
+                tarfile.open(fileobj=fp, mode="r|") as tar:
+            for m in tar:
+                if StateArchive._normalize(m.name) == "":
                     continue
-                l = line.split()
-                if len(l) > 2 and not l[2].endswith("/"):
-                    return l[2]
+                if (StateArchive._normalize(m.name) !=
+                        "var/lib/apt-clone/manifest"):
+                    return None
+                f = tar.extractfile(m)
+                compression = m.pax_headers.get(PAX_COMPRESSION)
+                if compression:
+                    f = _open_member_decompressed(f, compression)
+                return f.read()
         return None
 
-    def _get_clone_info_dict(self, statefile):
-        distro = self._get_info_distro(statefile) or "unknown"
+    def _get_clone_info_dict(self, archive):
+        if "var/lib/apt-clone/manifest" in archive:
+            return self._get_info_dict_from_manifest(
+                archive.read("var/lib/apt-clone/manifest"))
+        distro = self._get_info_distro(archive) or "unknown"
         # nr installed
-        with tarfile.open(statefile) as tar:
-            f = tar.extractfile(
-                self.TARPREFIX + "var/lib/apt-clone/installed.pkgs")
-            installed = autoinstalled = 0
-            meta = []
-            for line in f.readlines():
-                line = line.decode("utf-8")
-                (name, version, auto) = line.strip().split()
-                installed += 1
-                if int(auto):
-                    autoinstalled += 1
-                # FIXME: this is a bad way to figure out about the
-                # meta-packages
-                if name.endswith("-desktop"):
-                    meta.append(name)
-            # date
-            m = tar.getmember(
-                self.TARPREFIX + "var/lib/apt-clone/installed.pkgs")
-            date = m.mtime
-            # check hostname (if found)
-            hostname = "unknown"
-            arch = "unknown"
-            if self.TARPREFIX+"var/lib/apt-clone/uname" in tar.getnames():
-                info = tar.extractfile(
-                    self.TARPREFIX + "var/lib/apt-clone/uname").read()
-                section = apt_pkg.TagSection(info)
-                hostname = section.get("hostname", "unknown")
-                arch = section.get("arch", "unknown")
-            return { 'hostname' : hostname,
-                     'distro' : distro,
-                     'meta' : ", ".join(meta),
-                     'installed' : installed,
-                     'autoinstalled' : autoinstalled,
-                     'date' : time.ctime(date),
-                     'arch' : arch,
-                   }
+        installed = autoinstalled = 0
+        meta = []
+        for (name, version, auto) in self._iter_sorted_installed_pkgs(archive):
+            installed += 1
+            autoinstalled += auto
+            # FIXME: this is a bad way to figure out about the
+            # meta-packages
+            if name.endswith("-desktop"):
+                meta.append(name)
+        # date
+        m = archive.getmember("var/lib/apt-clone/installed.pkgs")
+        date = int(m.mtime)
+        # check hostname (if found)
+        hostname = "unknown"
+        arch = "unknown"
+        if "var/lib/apt-clone/uname" in archive:
+            info = archive.read("var/lib/apt-clone/uname")
+            section = apt_pkg.TagSection(info)
+            hostname = section.get("hostname", "unknown")
+            arch = section.get("arch", "unknown")
+        return { 'hostname' : hostname,
+                 'distro' : distro,
+                 'meta' : ", ".join(meta),
+                 'installed' : installed,
+                 'autoinstalled' : autoinstalled,
+                 'date' : date,
+                 'arch' : arch,
+               }
+
+    def get_info(self, statefile):
+        """ return a dict with the hostname, arch, distro, meta (list of
+            meta-packages), installed and autoinstalled (number of
+            packages) and date (seconds since the epoch) of the clone
+
+            Only the manifest at the start of the clone file is read if
+            there is one.
+        """
+        manifest = None
+        if not isinstance(statefile, StateArchive):
+            manifest = self._read_manifest(statefile)
+        if manifest is not None:
+            info = self._get_info_dict_from_manifest(manifest)
+        else:
+            with self._open_state(statefile) as archive:
+                info = self._get_clone_info_dict(archive)
+        info["meta"] = [name for name in info["meta"].split(", ") if name]
+        return info
 
     def info(self, statefile):
+        return self.format_info(self.get_info(statefile))
+
+    def format_info(self, info):
+        """ return the text for the get_info() dict info """
+        info = dict(info, meta=", ".join(info["meta"]),
+                    date=time.ctime(info["date"]))
         return "Hostname: %(hostname)s\n"\
                "Arch: %(arch)s\n"\
                "Distro: %(distro)s\n"\
                "Meta: %(meta)s\n"\
                "Installed: %(installed)s pkgs (%(autoinstalled)s automatic)\n"\
-               "Date: %(date)s\n" % self._get_clone_info_dict(statefile)
+               "Date: %(date)s\n" % info
+
+    def info_many(self, statefiles, jobs=1):
+        """ yield a dict with the file and its get_info() (or the error)
+            for each clone file in statefiles, in order, up to jobs clone
+            files are read in parallel processes
+        """
+        statefiles = list(statefiles)
+        if jobs > 1 and len(statefiles) > 1:
+            with _pool(min(jobs, len(statefiles))) as pool:
+                for result in pool.imap(_info_worker, statefiles,
+                                        chunksize=8):
+                    yield result
+            return
+        for statefile in statefiles:
+            yield _info_worker(statefile, self)
 
     # show-diff
-    def _get_file_diff_against_clone(self, statefile, system_file, targetdir):
-        with tarfile.open(statefile) as tar:
-            self._detect_tarprefix(tar)
-            clone_file = tar.extractfile(self.TARPREFIX+system_file[1:])
-            clone_file_lines = []
+    def _get_file_diff_against_clone(self, archive, system_file, targetdir):
+        clone_file_lines = []
+        if system_file[1:] in archive:
+            clone_file = archive.extractfile(system_file[1:])
             # FIXME: is there a better way for this? something to tell
             #        tarfile that really its all utf8?
             for line in clone_file.readlines():
                 clone_file_lines.append(line.decode("utf-8"))
-        system_file = targetdir+system_file
+        system_file = os.path.join(targetdir, system_file[1:])
         if os.path.exists(system_file):
             with open(system_file) as fp:
                 system_file_lines = fp.readlines()
@@ -397,112 +2288,411 @@ class AptClone(object):
             diff.append(line)
         return diff
 
-    def show_diff(self, statefile, targetdir="/"):
-        if targetdir != "/":
-            apt_pkg.config.set("DPkg::Chroot-Directory", targetdir)
+    def _get_system_names(self, targetdir, dirname, pattern="*"):
+        """ return the names of the files matching pattern in dirname
+            (like "/etc/apt/sources.list.d") below targetdir
+        """
+        path = os.path.join(targetdir, dirname[1:])
+        if not os.path.isdir(path):
+            return set()
+        return set(os.path.join(dirname, name)
+                   for name in fnmatch.filter(os.listdir(path), pattern)
+                   if not os.path.isdir(os.path.join(path, name)))
 
-        # show info/uname diff
-        print("Clone info differences: ")
+    def _get_clone_names(self, archive, dirname, pattern="*"):
+        return set("/" + archive._normalize(m.name)
+                   for m in archive.getmembers_under(dirname[1:])
+                   if not m.isdir() and
+                   fnmatch.fnmatch(os.path.basename(m.name), pattern))
+
+    def _get_keyring_diff(self, archive, targetdir):
+        """ return a dict with the keyrings that are only in the clone,
+            only on the system or that differ
+        """
+        diff = {"only_in_clone": [], "only_on_system": [], "changed": []}
+        keyrings = set(["/etc/apt/trusted.gpg"])
+        keyrings |= self._get_system_names(targetdir, "/etc/apt/trusted.gpg.d")
+        keyrings |= self._get_clone_names(archive, "/etc/apt/trusted.gpg.d")
+        for keyring in sorted(keyrings):
+            path = os.path.join(targetdir, keyring[1:])
+            in_clone = keyring[1:] in archive
+            on_system = os.path.isfile(path)
+            if in_clone and not on_system:
+                diff["only_in_clone"].append(keyring)
+            elif on_system and not in_clone:
+                diff["only_on_system"].append(keyring)
+            elif (in_clone and on_system and
+                    archive.get_digest(keyring[1:]) != _get_file_digest(path)):
+                diff["changed"].append(keyring)
+        return diff
+
+    def get_package_set(self, statefile):
+        """ return the ClonePackageSet of the installed packages in the
+            clone statefile
+        """
+        with self._open_state(statefile) as archive:
+            return self._get_package_set(archive)
+
+    def _get_package_set(self, archive):
+        with archive.extractfile("var/lib/apt-clone/installed.pkgs") as f:
+            return ClonePackageSet.from_file(f)
+
+    def _iter_installed_pkgs(self, archive):
+        """ yield (name, version, auto_installed) for the installed.pkgs
+            of the archive, line by line
+        """
+        with archive.extractfile("var/lib/apt-clone/installed.pkgs") as f:
+            for entry in _parse_installed_pkgs(f):
+                yield entry
+
+    def _iter_sorted_installed_pkgs(self, archive):
+        """ like _iter_installed_pkgs but sorted by name, clone files
+            are written sorted so this only needs to sort (in memory)
+            for old clone files
+        """
+        last = None
+        for (name, version, auto) in self._iter_installed_pkgs(archive):
+            if last is not None and name < last:
+                return iter(self._get_package_set(archive))
+            last = name
+        return self._iter_installed_pkgs(archive)
+
+    def _get_pkgs_diff(self, archive, targetdir):
+        """ return a dict with the differences of the installed packages
+            in the clone and on the system, the system packages are read
+            from its dpkg status (no apt cache is opened for this)
+        """
+        if targetdir == "/":
+            system = self._get_installed_pkgs_from_dpkg_status()
+        else:
+            system = self._get_installed_pkgs_from_dpkg_status(
+                os.path.join(targetdir, "var/lib/dpkg/status"),
+                os.path.join(targetdir, "var/lib/apt/extended_states"))
+        diff = {"only_on_system": [], "only_in_clone": [],
+                "version_differences": [], "auto_differences": []}
+        # both are sorted by name, so merge them in a single pass
+        for name, clone, system in _merge_pkgs(
+                self._get_package_set(archive), system):
+            if system is None:
+                diff["only_in_clone"].append(name)
+            elif clone is None:
+                diff["only_on_system"].append(name)
+            else:
+                if clone[1] != system[1]:
+                    diff["version_differences"].append(
+                        (name, clone[1], system[1]))
+                if clone[2] != system[2]:
+                    diff["auto_differences"].append(
+                        (name, clone[2], system[2]))
+        return diff
+
+    @_with_apt_config
+    def get_diff(self, statefile, targetdir="/"):
+        """ return a dict with the difference of the clone statefile to
+            the system in targetdir
+        """
+        with self._open_state(statefile) as archive:
+            return self._get_diff(archive, targetdir)
+
+    def _get_diff(self, archive, targetdir):
+        diff = {}
+        # info/uname diff
+        diff["info"] = {}
         host_info = self._get_host_info_dict()
-        clone_info = self._get_clone_info_dict(statefile)
+        clone_info = self._get_clone_info_dict(archive)
         for key in host_info:
             if host_info.get(key, None) != clone_info.get(key, None):
-                print(" '%s': clone='%s' system='%s'" % (
-                        key, clone_info.get(key, None),
-                        host_info.get(key, None)))
+                diff["info"][key] = {"clone": clone_info.get(key, None),
+                                     "system": host_info.get(key, None)}
+        # sources.list{,.d} diff
+        sources = set(["/etc/apt/sources.list"])
+        sources |= self._get_system_names(
+            targetdir, "/etc/apt/sources.list.d", "*.list")
+        sources |= self._get_clone_names(
+            archive, "/etc/apt/sources.list.d", "*.list")
+        diff["sources"] = {}
+        for path in sorted(sources):
+            file_diff = self._get_file_diff_against_clone(
+                archive, path, targetdir)
+            if file_diff:
+                diff["sources"][path] = file_diff
+        diff["keyrings"] = self._get_keyring_diff(archive, targetdir)
+        diff["packages"] = self._get_pkgs_diff(archive, targetdir)
+        return diff
+
+    @_with_apt_config
+    def show_diff(self, statefile, targetdir="/", format="text"):
+        with self._open_state(statefile) as archive:
+            self._show_diff(archive, targetdir, format)
+
+    def _show_diff(self, archive, targetdir, format="text"):
+        diff = self._get_diff(archive, targetdir)
+        if format == "json":
+            print(json.dumps(diff, indent=2, sort_keys=True))
+            return
+
+        # show info/uname diff
+        print("Clone info differences: ")
+        for key, values in diff["info"].items():
+            print(" '%s': clone='%s' system='%s'" % (
+                    key, values["clone"], values["system"]))
         print("")
 
         # show sources.list{,.d} diff
-        sources_list_system = "/etc/apt/sources.list"
-        diff = self._get_file_diff_against_clone(
-            statefile, sources_list_system, targetdir)
-        if diff:
-            print("".join(diff))
-
-        # FIXME: do sources.list.d diff too
-        # FIXME: do apt-keyring diff
-        #self._restore_package_selection(statefile, targetdir, protect_installed)
-        # create new cache in the rootdir
-        cache = self._cache_cls(rootdir=targetdir)
-        with tarfile.open(statefile) as tar:
-            f = tar.extractfile(
-                self.TARPREFIX + "var/lib/apt-clone/installed.pkgs")
-            # get the data
-            installed_in_clone = {}
-            for line in f.readlines():
-                line = line.strip().decode('utf-8')
-                if line.startswith("#") or line == "":
-                    continue
-                (name, version, auto) = line.split()
-                installed_in_clone[name] = (version, auto)
-        installed_on_system = {}
-        for pkg in cache:
-            if not pkg.installed:
-                continue
-            installed_on_system[pkg.name] = (
-                pkg.installed.version, str(pkg.is_auto_installed))
+        for path in sorted(diff["sources"]):
+            print("".join(diff["sources"][path]))
 
-        only_on_system = set(installed_on_system.keys()) - set(installed_in_clone.keys())
-        if only_on_system:
+        # show apt-keyring diff
+        for key, title in (
+                ("only_in_clone", "Keyrings in the clone-file but not in the system:"),
+                ("only_on_system", "Keyrings on the system but not in the clone-file:"),
+                ("changed", "Keyrings that differ:")):
+            if diff["keyrings"][key]:
+                print(title)
+                print(" ".join(diff["keyrings"][key]))
+                print("\n")
+
+        pkgs = diff["packages"]
+        if pkgs["only_on_system"]:
             print("Installed on the system but not in the clone-file:")
-            print(" ".join(sorted(only_on_system)))
+            print(" ".join(pkgs["only_on_system"]))
             print("\n")
 
-        only_in_clone =  set(installed_in_clone.keys()) - set(installed_on_system.keys())
-        if only_in_clone:
+        if pkgs["only_in_clone"]:
             print("Installed in the clone-file but not in the system:")
-            print(" ".join(sorted(only_in_clone)))
+            print(" ".join(pkgs["only_in_clone"]))
             print("\n")
 
         # show version differences
-        pkgversion_differences = set()
-        for pkgname in sorted(installed_in_clone):
-            if not pkgname in installed_on_system:
-                continue
-            clone_file_pkgversion, clone_is_auto = installed_in_clone[pkgname]
-            system_pkgversion, sys_is_auto = installed_on_system[pkgname]
-            if clone_file_pkgversion != system_pkgversion:
-                pkgversion_differences.add(
-                    (pkgname, clone_file_pkgversion, system_pkgversion))
-        if pkgversion_differences:
+        if pkgs["version_differences"]:
             print("Version differences: ")
             print("Pkgname <clone-file-version> <system-version>")
-            for pkgname, clone_ver, system_ver in pkgversion_differences:
+            for pkgname, clone_ver, system_ver in pkgs["version_differences"]:
                 print(" %s  <%s>   <%s>" % (pkgname, clone_ver, system_ver))
 
+        if pkgs["auto_differences"]:
+            print("Auto-installed differences: ")
+            print("Pkgname <clone-file-auto> <system-auto>")
+            for pkgname, clone_auto, system_auto in pkgs["auto_differences"]:
+                print(" %s  <%s>   <%s>" % (pkgname, clone_auto, system_auto))
+
+
+    def diff_clones(self, old_statefile, new_statefile):
+        """ return a dict with the difference between the two clone
+            files, no system is looked at for this
+        """
+        with self._open_state(old_statefile) as old, \
+                self._open_state(new_statefile) as new:
+            return self._diff_clones(old, new)
+
+    # members that are compared between two clone files
+    DIFF_CLONES_PREFIXES = ("etc/", "extra-files/", "modified-conffiles/",
+                            "unowned-files/")
+
+    def _diff_clones(self, old, new):
+        diff = {}
+        # clone info
+        diff["info"] = {}
+        old_info = self._get_clone_info_dict(old)
+        new_info = self._get_clone_info_dict(new)
+        for key in sorted(set(old_info) | set(new_info)):
+            if key == "date":
+                continue
+            if old_info.get(key) != new_info.get(key):
+                diff["info"][key] = {"old": old_info.get(key),
+                                     "new": new_info.get(key)}
+        # packages, streamed from the two sorted installed.pkgs
+        pkgs = {"added": [], "removed": [],
+                "version_changes": [], "auto_changes": []}
+        for name, a, b in _merge_pkgs(
+                self._iter_sorted_installed_pkgs(old),
+                self._iter_sorted_installed_pkgs(new)):
+            if a is None:
+                pkgs["added"].append(name)
+            elif b is None:
+                pkgs["removed"].append(name)
+            else:
+                if a[1] != b[1]:
+                    pkgs["version_changes"].append((name, a[1], b[1]))
+                if a[2] != b[2]:
+                    pkgs["auto_changes"].append((name, a[2], b[2]))
+        diff["packages"] = pkgs
+        # sources, keyrings, extra files etc
+        files = {"added": [], "removed": [], "changed": []}
+        old_names = set(name for name in old.getnames()
+                        if name.startswith(self.DIFF_CLONES_PREFIXES) and
+                        not old.getmember(name).isdir())
+        new_names = set(name for name in new.getnames()
+                        if name.startswith(self.DIFF_CLONES_PREFIXES) and
+                        not new.getmember(name).isdir())
+        diff["sources"] = {}
+        for name in sorted(old_names | new_names):
+            if name not in old_names:
+                files["added"].append("/" + name)
+            elif name not in new_names:
+                files["removed"].append("/" + name)
+            elif old.get_digest(name) != new.get_digest(name):
+                files["changed"].append("/" + name)
+            else:
+                continue
+            if name.startswith("etc/apt/sources.list"):
+                diff["sources"]["/" + name] = self._get_member_diff(
+                    old, new, name)
+        diff["files"] = files
+        return diff
+
+    def _get_member_diff(self, old, new, name):
+        """ return the unified diff of the text member name """
+        lines = []
+        for archive in (old, new):
+            if name in archive:
+                data = archive.read(name).decode("utf-8")
+                lines.append(data.splitlines(True))
+            else:
+                lines.append([])
+        return list(difflib.unified_diff(
+            lines[0], lines[1], fromfile="old/" + name, tofile="new/" + name))
+
+    def show_clone_diff(self, old_statefile, new_statefile, format="text"):
+        diff = self.diff_clones(old_statefile, new_statefile)
+        if format == "json":
+            print(json.dumps(diff, indent=2, sort_keys=True))
+            return
+        if diff["info"]:
+            print("Clone info differences: ")
+            for key, values in sorted(diff["info"].items()):
+                print(" '%s': old='%s' new='%s'" % (
+                    key, values["old"], values["new"]))
+            print("")
+        for path in sorted(diff["sources"]):
+            print("".join(diff["sources"][path]))
+        pkgs = diff["packages"]
+        for key, title in (("added", "Added packages:"),
+                           ("removed", "Removed packages:")):
+            if pkgs[key]:
+                print(title)
+                print(" ".join(pkgs[key]))
+                print("\n")
+        if pkgs["version_changes"]:
+            print("Version changes: ")
+            print("Pkgname <old-version> <new-version>")
+            for pkgname, old_ver, new_ver in pkgs["version_changes"]:
+                print(" %s  <%s>   <%s>" % (pkgname, old_ver, new_ver))
+        if pkgs["auto_changes"]:
+            print("Auto-installed changes: ")
+            print("Pkgname <old-auto> <new-auto>")
+            for pkgname, old_auto, new_auto in pkgs["auto_changes"]:
+                print(" %s  <%s>   <%s>" % (pkgname, old_auto, new_auto))
+        for key, title in (("added", "Added files:"),
+                           ("removed", "Removed files:"),
+                           ("changed", "Changed files:")):
+            if diff["files"][key]:
+                print(title)
+                print(" ".join(diff["files"][key]))
+                print("\n")
+
+    @_with_apt_config
+    def check_availability(self, statefile, packages_dirs):
+        """ return the sorted list of (name, version) of the installed
+            packages of the clone statefile that are not in the Packages
+            files below packages_dirs (e.g. the dists dir of a mirror)
+        """
+        with self._open_state(statefile) as archive:
+            native_arch = self._get_clone_info_dict(archive).get("arch")
+            if not native_arch or native_arch == "unknown":
+                native_arch = apt_pkg.config.find("APT::Architecture")
+            available = set()
+            for packages_dir in packages_dirs:
+                for path in _find_packages_files(packages_dir):
+                    _index_packages_file(path, native_arch, available)
+            unavailable = []
+            for (name, version, auto) in self._get_package_set(archive):
+                if ("%s %s" % (name, version)).encode("utf-8") not in available:
+                    unavailable.append((name, version))
+        return unavailable
+
+    def _get_clone_many_target(self, sourcedir, outdir):
+        # escape "%" and "_" so that "/srv/a_b" and "/srv/a/b" differ
+        name = os.path.abspath(sourcedir).strip("/")
+        name = name.replace("%", "%25").replace("_", "%5F").replace("/", "_")
+        return os.path.join(outdir, name or "root")
+
+    def clone_many(self, sourcedirs, outdir, jobs=1, **kwargs):
+        """ clone all the roots in sourcedirs into outdir (the keyword
+            arguments are passed to save_state) and yield a result dict
+            for each root as soon as it is done
+
+            Every root is cloned in its own worker process because
+            save_state changes the global apt configuration, up to jobs
+            of them run in parallel.
+        """
+        args = []
+        sources = {}
+        for sourcedir in sourcedirs:
+            target = self._get_clone_many_target(sourcedir, outdir)
+            if target in sources:
+                raise ValueError("'%s' and '%s' are the same root" % (
+                    sources[target], sourcedir))
+            sources[target] = sourcedir
+            args.append((self._cache_cls, sourcedir, target, kwargs))
+        if not args:
+            return
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        with _pool(max(1, jobs), maxtasksperchild=1) as pool:
+            for result in pool.imap_unordered(_clone_many_worker, args):
+                yield result
 
     # restore
+    @_with_apt_config
     def restore_state(self, statefile, targetdir="/", exclude_pkgs=None,
-                      new_distro=None, protect_installed=False, mirror=None):
+                      new_distro=None, protect_installed=False, mirror=None,
+                      lists_from_clone=False, lists_max_age=None,
+                      with_modified_conffiles=False):
         """ take a statefile produced via (like apt-state.tar.gz)
             save_state() and restore the packages/repositories
             into targetdir (that is usually "/")
+
+            With with_modified_conffiles=True the locally modified (and
+            removed) conffiles stored in the clone are restored too, this
+            is skipped for a new_distro as they belong to the old release.
+
+            With lists_from_clone=True the package lists stored in the
+            clone (see save_state(with_lists=True)) are used. The lists
+            are only updated if they are older than lists_max_age
+            seconds (or always if no lists_max_age and no lists from the
+            clone are used).
         """
+        self._check_lists_from_clone(lists_from_clone, new_distro)
 
         if targetdir != "/":
             apt_pkg.config.set("DPkg::Chroot-Directory", targetdir)
             self.commands.bind_mount("/proc", os.path.join(targetdir, "proc"))
             self.commands.bind_mount("/sys", os.path.join(targetdir, "sys"))
 
-        # detect prefix
-        with tarfile.open(statefile) as tar:
-            self._detect_tarprefix(tar)
+        with self._open_state(statefile) as archive:
+            if not os.path.exists(targetdir):
+                print("Dir '%s' does not exist, need to bootstrap first" % targetdir)
+                distro = self._get_info_distro(archive)
+                self.commands.debootstrap(targetdir, distro)
 
-        if not os.path.exists(targetdir):
-            print("Dir '%s' does not exist, need to bootstrap first" % targetdir)
-            distro = self._get_info_distro(statefile)
-            self.commands.debootstrap(targetdir, distro)
-
-        self._restore_sources_list(statefile, targetdir, mirror=mirror)
-        self._restore_apt_keyring(statefile, targetdir)
-        if new_distro:
-            self._rewrite_sources_list(targetdir, new_distro)
-        self._restore_package_selection(statefile, targetdir, protect_installed, exclude_pkgs)
-        # FIXME: this needs to check if there are conflicts, e.g. via
-        #        gdebi
-        self._restore_not_downloadable_debs(statefile, targetdir)
-        # restore after package to avoid e.g. conffile prompts
-        self._restore_extra_files(statefile, targetdir)
+            self._restore_sources_list(archive, targetdir, mirror=mirror)
+            self._restore_apt_keyring(archive, targetdir)
+            if new_distro:
+                self._rewrite_sources_list(targetdir, new_distro)
+            self._restore_package_selection(
+                archive, targetdir, protect_installed, exclude_pkgs,
+                lists_from_clone, lists_max_age)
+            # FIXME: this needs to check if there are conflicts, e.g. via
+            #        gdebi
+            self._restore_not_downloadable_debs(archive, targetdir)
+            # restore after package to avoid e.g. conffile prompts
+            if with_modified_conffiles and new_distro:
+                logging.warning("not restoring the modified conffiles of "
+                                "the old release on %s" % new_distro)
+            elif with_modified_conffiles:
+                self._restore_modified_conffiles(archive, targetdir)
+            self._restore_extra_files(archive, targetdir)
 
         # and umount again
         if targetdir != "/":
@@ -510,79 +2700,244 @@ class AptClone(object):
             self.commands.bind_umount(os.path.join(targetdir, "sys"))
 
     # simulate restore and return list of missing pkgs
-    def simulate_restore_state(self, statefile, exclude_pkgs, new_distro=None):
-        # create tmp target (with host system dpkg-status) to simulate in
+    @_with_apt_config
+    def simulate_restore_state(self, statefile, exclude_pkgs, new_distro=None,
+                               offline=False, lists_dir=None,
+                               lists_from_clone=False):
+        """ simulate the restore of statefile on this system and return
+            the set of packages that would be missing
+
+            With offline=True the package lists are not downloaded, they
+            are hardlinked from lists_dir (default: the host apt lists)
+            instead. With lists_from_clone=True the package lists stored
+            in the clone are used (they are downloaded if the clone has
+            none).
+        """
+        self._check_lists_from_clone(lists_from_clone, new_distro)
+        if lists_from_clone and offline:
+            raise ValueError("offline and lists_from_clone can not be "
+                             "used together")
+        with self._open_state(statefile) as archive:
+            target = self._create_simulate_root(
+                archive, new_distro, offline, lists_dir)
+            try:
+                if lists_from_clone and self._restore_lists(archive, target):
+                    offline = True
+                cache = self._open_simulate_cache(target, offline)
+                # try to replay cache and see thats missing
+                missing = self._restore_package_selection_in_cache(archive, cache, exclude_pkgs=exclude_pkgs)
+            finally:
+                shutil.rmtree(target)
+        return missing
+
+    def _create_simulate_root(self, archive, new_distro=None, offline=False,
+                              lists_dir=None, sources_list=None):
+        """ create a tmp root (with host system dpkg-status) with the
+            sources of the clone archive (or the given sources_list file)
+            to simulate in
+        """
+        if offline and lists_dir is None:
+            lists_dir = apt_pkg.config.find_dir("Dir::State::lists")
         target = tempfile.mkdtemp()
         dpkg_status = apt_pkg.config.find_file("dir::state::status")
         if not os.path.exists(target+os.path.dirname(dpkg_status)):
             os.makedirs(target+os.path.dirname(dpkg_status))
         shutil.copy(dpkg_status, target+dpkg_status)
-        # restore sources.list and update cache in tmp target
-        self._restore_sources_list(statefile, target)
+        # restore sources.list
+        if sources_list is not None:
+            os.makedirs(os.path.join(target, "etc", "apt"))
+            shutil.copy(sources_list,
+                        os.path.join(target, "etc", "apt", "sources.list"))
+        else:
+            self._restore_sources_list(archive, target)
         # optionally rewrite on new distro
         if new_distro:
             self._rewrite_sources_list(target, new_distro)
+        if offline:
+            _seed_lists(lists_dir, target)
+        return target
+
+    def _open_simulate_cache(self, target, offline=False):
+        """ open the cache for the simulate root target, the package
+            lists are updated first unless offline is set
+        """
         cache = self._cache_cls(rootdir=target)
-        try:
-            cache.update(apt.progress.base.AcquireProgress())
-        except FetchFailedException:
-            # This cannot be resolved here, but it should not be interpreted as
-            # a fatal error.
-            pass
+        if not offline:
+            try:
+                cache.update(apt.progress.base.AcquireProgress())
+            except FetchFailedException:
+                # This cannot be resolved here, but it should not be interpreted as
+                # a fatal error.
+                pass
         cache.open()
-        # try to replay cache and see thats missing
-        missing = self._restore_package_selection_in_cache(statefile, cache, exclude_pkgs=exclude_pkgs)
-        shutil.rmtree(target)
-        return missing
+        return cache
+
+    def simulate_restore_batch(self, statefiles, exclude_pkgs=None,
+                               sources_list=None, new_distro=None,
+                               offline=False, lists_dir=None, jobs=1):
+        """ simulate the restore of many clone statefiles against one
+            cache and yield (statefile, missing, error) for each of them
 
-    def _restore_sources_list(self, statefile, targetdir, mirror=None):
-        with tarfile.open(statefile) as tar:
-            existing = os.path.join(targetdir, "etc", "apt", "sources.list")
-            if os.path.exists(existing):
-                shutil.copy(existing, '%s.apt-clone' % existing)
-            tar.extract(self.TARPREFIX+"etc/apt/sources.list", targetdir)
-            td_sources = os.path.join(targetdir, "etc", "apt", "sources.list")
-            os.chmod(td_sources, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
-                     stat.S_IROTH)
-            if mirror:
-                from aptsources.sourceslist import SourcesList
-                apt_pkg.config.set("Dir::Etc::sourcelist", td_sources)
-                sources = SourcesList()
-                for entry in sources.list[:]:
-                    if entry.uri != mirror:
-                       entry.uri = mirror
-                sources.save()
+            The cache is built (and updated) once from sources_list, or
+            the sources of the first statefile, and reset for each clone.
+            With jobs > 1 the statefiles are spread over that many
+            processes that each open their own cache.
+        """
+        statefiles = list(statefiles)
+        if not statefiles:
+            return
+        if jobs > 1 and len(statefiles) > 1:
+            args = [(self._cache_cls, statefiles[i::jobs], statefiles[0],
+                     exclude_pkgs, sources_list, new_distro, offline,
+                     lists_dir)
+                    for i in range(min(jobs, len(statefiles)))]
+            with _pool(len(args)) as pool:
+                for results in pool.imap_unordered(
+                        _simulate_restore_batch_worker, args):
+                    for result in results:
+                        yield result
+            return
+        for result in self._simulate_restore_batch(
+                statefiles, statefiles[0], exclude_pkgs, sources_list,
+                new_distro, offline, lists_dir):
+            yield result
+
+    def _simulate_restore_batch(self, statefiles, sources_from,
+                                exclude_pkgs=None, sources_list=None,
+                                new_distro=None, offline=False,
+                                lists_dir=None):
+        # apt_pkg.config is only ours while the cache is set up and while
+        # a clone is replayed, the caller runs between the yields
+        with _apt_config_context():
+            with self._open_state(sources_from) as archive:
+                target = self._create_simulate_root(
+                    archive, new_distro, offline, lists_dir, sources_list)
             try:
-                tar.extract(self.TARPREFIX+"etc/apt/sources.list.d", targetdir)
-            except KeyError:
-                pass
+                cache = self._open_simulate_cache(target, offline)
+            except Exception:
+                shutil.rmtree(target)
+                raise
+            simulate_config = _snapshot_apt_config()
+        try:
+            for statefile in statefiles:
+                with _apt_config_context():
+                    _restore_apt_config(simulate_config)
+                    # forget the marks of the previous clone
+                    cache.clear()
+                    try:
+                        missing = self._restore_package_selection_in_cache(
+                            statefile, cache, exclude_pkgs=exclude_pkgs)
+                    except Exception as e:
+                        logging.exception(
+                            "simulating %s failed" % statefile)
+                        result = (statefile, None, str(e))
+                    else:
+                        result = (statefile, missing, None)
+                yield result
+        finally:
+            shutil.rmtree(target)
 
-    def _restore_apt_keyring(self, statefile, targetdir):
+    def _restore_sources_list(self, archive, targetdir, mirror=None):
+        existing = os.path.join(targetdir, "etc", "apt", "sources.list")
+        if os.path.exists(existing):
+            shutil.copy(existing, '%s.apt-clone' % existing)
+        archive.extract("etc/apt/sources.list", targetdir)
+        td_sources = os.path.join(targetdir, "etc", "apt", "sources.list")
+        os.chmod(td_sources, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP |
+                 stat.S_IROTH)
+        if mirror:
+            from aptsources.sourceslist import SourcesList
+            apt_pkg.config.set("Dir::Etc::sourcelist", td_sources)
+            sources = SourcesList()
+            for entry in sources.list[:]:
+                if entry.uri != mirror:
+                   entry.uri = mirror
+            sources.save()
+        try:
+            archive.extract_tree("etc/apt/sources.list.d", targetdir)
+        except KeyError:
+            pass
+
+    def _restore_apt_keyring(self, archive, targetdir):
         existing = os.path.join(targetdir, "etc", "apt", "trusted.gpg")
         backup = '%s.apt-clone' % existing
         if os.path.exists(existing):
             shutil.copy(existing, backup)
-        with tarfile.open(statefile) as tar:
-            try:
-                tar.extract(self.TARPREFIX+"etc/apt/trusted.gpg", targetdir)
-            except KeyError:
-                pass
+        try:
+            archive.extract("etc/apt/trusted.gpg", targetdir)
+        except KeyError:
+            pass
+        try:
+            archive.extract_tree("etc/apt/trusted.gpg.d", targetdir)
+        except KeyError:
+            pass
+        if os.path.exists(backup):
+            self.commands.merge_keys(backup, existing)
+            os.remove(backup)
+
+    def _get_exclude_matcher(self, exclude_pkgs):
+        """ return a function that tells if a package name matches one
+            of the exclude_pkgs glob patterns (compiled into one regexp)
+        """
+        if not exclude_pkgs:
+            return lambda name: False
+        regexp = re.compile("|".join(
+            "(?:%s)" % fnmatch.translate(excl) for excl in exclude_pkgs))
+        return lambda name: regexp.match(name) is not None
+
+    def _mark_pkgs_in_cache(self, cache, resolver, marks):
+        """ mark the (pkg, auto_installed) marks for install (without
+            fixing anything) and resolve once, returns False if the
+            resulting cache is broken
+        """
+        cache.clear()
+        with cache.actiongroup():
+            for pkg, auto_installed in marks:
+                try:
+                    pkg.mark_install(from_user=not auto_installed,
+                                     auto_fix=False)
+                except SystemError as e:
+                    logging.debug("can't mark %s (%s)" % (pkg.name, e))
+                    return False
+                # ensure the auto install info is
+                pkg.mark_auto(auto_installed)
+        if cache.broken_count > 0:
             try:
-                tar.extract(self.TARPREFIX+"etc/apt/trusted.gpg.d", targetdir)
-            except KeyError:
-                pass
-            if os.path.exists(backup):
-                self.commands.merge_keys(backup, existing)
-                os.remove(backup)
+                resolver.resolve()
+            except SystemError as e:
+                logging.debug("can't resolve (%s)" % e)
+                return False
+        return cache.broken_count == 0
+
+    def _bisect_uninstallable(self, cache, resolver, accepted, marks,
+                              failed):
+        """ find the marks that can not be installed together with the
+            accepted ones, the installable ones are added to accepted
+        """
+        if self._mark_pkgs_in_cache(cache, resolver, accepted + marks):
+            accepted.extend(marks)
+            return
+        if len(marks) == 1:
+            logging.warning("can't add %s" % marks[0][0].name)
+            failed.append(marks[0])
+            return
+        middle = len(marks) // 2
+        self._bisect_uninstallable(
+            cache, resolver, accepted, marks[:middle], failed)
+        self._bisect_uninstallable(
+            cache, resolver, accepted, marks[middle:], failed)
 
     def _restore_package_selection_in_cache(self, statefile, cache, protect_installed=False, exclude_pkgs=None):
-        # deal with excludes
-        if exclude_pkgs is None:
-            exclude_pkgs = []
-        exclude_pkgs = set(exclude_pkgs)
-        # reinstall packages
+        """ mark the packages of the clone statefile for install in cache
+            and return the set of package names that can not be installed
+
+            All manual packages are marked first and the auto installed
+            ones after them, then the resolver runs once for the whole
+            selection. Only if that fails the selection is bisected to
+            find the packages that can not be installed.
+        """
+        is_excluded = self._get_exclude_matcher(exclude_pkgs)
         missing = set()
-        pkgs = set()
         # procted installed pkgs
         resolver = apt_pkg.ProblemResolver(cache._depcache)
         if protect_installed:
@@ -590,88 +2945,134 @@ class AptClone(object):
                 if pkg.is_installed:
                     resolver.protect(pkg._pkg)
         # get the installed.pkgs data
-        with tarfile.open(statefile) as tar:
-            f = tar.extractfile(
-                self.TARPREFIX + "var/lib/apt-clone/installed.pkgs")
-            # the actiongroup will help libapt to speed up the following loop
-            with cache.actiongroup():
-                for line in f.readlines():
-                    line = line.strip().decode('utf-8')
-                    if line.startswith("#") or line == "":
-                        continue
-                    (name, version, auto) = line.split()
-                    # tiny helper
-                    def is_excluded(name, exclude_pkgs):
-                        for excl in exclude_pkgs:
-                            if fnmatch.fnmatch(name, excl):
-                                return True
-                    if is_excluded(name, exclude_pkgs):
-                        continue
-                    pkgs.add(name)
-                    auto_installed = int(auto)
-                    from_user = not auto_installed
-                    if name in cache:
-                        try:
-                            # special mode, most useful for release-upgrades
-                            if protect_installed:
-                                cache[name].mark_install(from_user=from_user, auto_fix=False)
-                                if cache.broken_count > 0:
-                                    resolver.resolve()
-                                    if not cache[name].marked_install:
-                                        raise SystemError("pkg %s not marked upgrade" % name)
-                            else:
-                                # normal mode, this assume the system is consistent
-                                cache[name].mark_install(from_user=from_user)
-                        except SystemError as e:
-                            logging.warning("can't add %s (%s)" % (name, e))
-                            missing.add(name)
-                        # ensure the auto install info is
-                        cache[name].mark_auto(auto_installed)
-        # check what is broken and try to fix
-        if cache.broken_count > 0:
-            resolver.resolve()
-        # now go over and see what is missing
-        for pkg in pkgs:
-            if not pkg in cache:
-                missing.add(pkg)
+        with self._open_state(statefile) as archive:
+            installed = self._get_package_set(archive)
+        manual = []
+        auto = []
+        for (name, version, auto_installed) in installed:
+            if is_excluded(name):
                 continue
-            if not (cache[pkg].is_installed or cache[pkg].marked_install):
-                missing.add(pkg)
+            if name not in cache:
+                missing.add(name)
+                continue
+            if auto_installed:
+                auto.append((cache[name], True))
+            else:
+                manual.append((cache[name], False))
+        marks = manual + auto
+        if not self._mark_pkgs_in_cache(cache, resolver, marks):
+            accepted = []
+            failed = []
+            self._bisect_uninstallable(cache, resolver, accepted, marks,
+                                       failed)
+            missing.update(pkg.name for pkg, auto_installed in failed)
+            # the last try may have been a failed one
+            self._mark_pkgs_in_cache(cache, resolver, accepted)
+        # now go over and see what is missing
+        for pkg, auto_installed in marks:
+            if not (pkg.is_installed or pkg.marked_install):
+                missing.add(pkg.name)
         return missing
 
-    def _restore_package_selection(self, statefile, targetdir, protect_installed, exclude_pkgs):
+    def _check_lists_from_clone(self, lists_from_clone, new_distro):
+        """ the lists of the clone are the ones of its release, apt has
+            no candidates from them once the sources point to new_distro
+        """
+        if lists_from_clone and new_distro:
+            raise ValueError("the package lists of the clone can not be "
+                             "used for a new distro")
+
+    def _restore_lists(self, archive, targetdir):
+        """ put the package lists of the clone into targetdir, returns
+            False if the clone has no lists
+        """
+        members = archive.getmembers_under("var/lib/apt-clone/lists")
+        if not members:
+            return False
+        listsdir = os.path.join("var", "lib", "apt", "lists")
+        os.makedirs(os.path.join(targetdir, listsdir, "partial"),
+                    exist_ok=True)
+        for m in members:
+            name = os.path.basename(archive._normalize(m.name))
+            archive.extract_member(
+                m, targetdir, arcname=os.path.join(listsdir, name))
+        return True
+
+    def _get_lists_age(self, listsdir):
+        """ return the age in seconds of the oldest Release file in
+            listsdir or None if there is none
+        """
+        mtimes = [os.path.getmtime(path) for path in glob.glob(
+            os.path.join(listsdir, "*Release"))]
+        if not mtimes:
+            return None
+        return time.time() - min(mtimes)
+
+    def _need_lists_update(self, archive, targetdir, lists_from_clone=False,
+                           lists_max_age=None):
+        """ seed the package lists in targetdir (if wanted) and tell
+            if they need to be updated
+        """
+        from_clone = lists_from_clone and self._restore_lists(
+            archive, targetdir)
+        if lists_max_age is None:
+            return not from_clone
+        age = self._get_lists_age(
+            os.path.join(targetdir, "var", "lib", "apt", "lists"))
+        return age is None or age > lists_max_age
+
+    def _restore_package_selection(self, archive, targetdir, protect_installed,
+                                   exclude_pkgs, lists_from_clone=False,
+                                   lists_max_age=None):
+        need_update = self._need_lists_update(
+            archive, targetdir, lists_from_clone, lists_max_age)
         # create new cache
         cache = self._cache_cls(rootdir=targetdir)
         # python-apt Cache(rootdir=) will mangle dir::bin, fix that
         apt.apt_pkg.config.set("Dir::Bin", "/")
         apt.apt_pkg.config.set("Dir::Bin::dpkg", "/usr/bin/dpkg")
-        try:
-            cache.update(self.fetch_progress)
-        except FetchFailedException:
-            # This cannot be resolved here, but it should not be interpreted as
-            # a fatal error.
-            pass
+        if need_update:
+            try:
+                cache.update(self.fetch_progress)
+            except FetchFailedException:
+                # This cannot be resolved here, but it should not be interpreted as
+                # a fatal error.
+                pass
+        else:
+            logging.debug("package lists are recent, not updating")
         cache.open()
-        self._restore_package_selection_in_cache(statefile, cache, protect_installed, exclude_pkgs)
+        self._restore_package_selection_in_cache(archive, cache, protect_installed, exclude_pkgs)
         # do it
         cache.commit(self.fetch_progress, self.install_progress)
 
-    def _restore_extra_files(self, statefile, targetdir):
-        with tarfile.open(statefile) as tar:
-            for m in tar.getmembers():
-                prefix = self.TARPREFIX+"extra-files/"
-                if m.name.startswith(prefix):
-                    # strip prefix on extract
-                    m.name = m.name[len(prefix):]
-                    tar.extract(m, targetdir)
-
-    def _restore_not_downloadable_debs(self, statefile, targetdir):
-        with tarfile.open(statefile) as tar:
-            try:
-                debsdir = [ tarinfo for tarinfo in tar.getmembers() if tarinfo.name.startswith(self.TARPREFIX+"var/lib/apt-clone/debs/")]
-                tar.extractall(targetdir,debsdir)
-            except KeyError:
-                return
+    def _restore_extra_files(self, archive, targetdir):
+        prefix = "extra-files/"
+        for m in archive.getmembers_under("extra-files"):
+            # strip prefix on extract
+            name = archive._normalize(m.name)[len(prefix):]
+            archive.extract_member(m, targetdir, arcname=name)
+
+    def _restore_modified_conffiles(self, archive, targetdir):
+        prefix = "modified-conffiles/"
+        for m in archive.getmembers_under("modified-conffiles"):
+            name = archive._normalize(m.name)[len(prefix):]
+            archive.extract_member(m, targetdir, arcname=name)
+        if "var/lib/apt-clone/removed-conffiles" in archive:
+            f = archive.extractfile("var/lib/apt-clone/removed-conffiles")
+            for line in f.readlines():
+                path = os.path.join(
+                    targetdir, line.decode("utf-8").strip().lstrip("/"))
+                if os.path.lexists(path) and not os.path.isdir(path):
+                    os.remove(path)
+
+    def _restore_not_downloadable_debs(self, archive, targetdir):
+        if "var/lib/apt-clone/repack-failed.pkgs" in archive:
+            f = archive.extractfile("var/lib/apt-clone/repack-failed.pkgs")
+            for line in f.readlines():
+                logging.warning("package %s was not repacked in the clone" %
+                                line.decode("utf-8").split()[0])
+        for m in archive.getmembers_under("var/lib/apt-clone/debs"):
+            archive.extract_member(m, targetdir)
         debs = []
         path = os.path.join(targetdir, "./var/lib/apt-clone/debs")
         for deb in glob.glob(os.path.join(path, "*.deb")):
@@ -721,61 +3122,88 @@ class AptClone(object):
                 entry.disabled = True
         sources.save()
 
-    def _find_unowned_in_etc(self, sourcedir=""):
+    def _find_unowned_in_etc(self, sourcedir="", ownership_index=None):
+        """ return the set of files below /etc that no package owns,
+            the dpkg ownership is taken from the optional OwnershipIndex
+            so that only changed .list files need to be read
+        """
         if sourcedir:
             etcdir = os.path.join(sourcedir, "etc")
         else:
             etcdir = "/etc"
         # get all the files that dpkg "owns"
-        owned = set()
         dpkg_basedir = os.path.dirname(apt_pkg.config.get("Dir::State::status"))
-        for f in glob.glob(os.path.join(dpkg_basedir, "info", "*.list")):
-            with open(f, encoding="utf-8") as fp:
-                for line in fp:
-                    if line.startswith("/etc/"):
-                        owned.add(line.strip())
+        if ownership_index is None:
+            ownership_index = OwnershipIndex(cachefile=None)
+        ownership_index.update(os.path.join(dpkg_basedir, "info"))
+        ownership_index.save()
+        owned = ownership_index.owned()
         # now go over etc
         unowned = set()
-        for dirpath, dirnames, filenames in os.walk(etcdir):
-            for name in filenames:
-                fullname = os.path.join(dirpath[len(sourcedir):], name)
-                if not fullname in owned:
-                    unowned.add(fullname)
+        for path in _walk_files(etcdir):
+            fullname = path[len(sourcedir):]
+            if not fullname in owned:
+                unowned.add(fullname)
         return unowned
 
-    def _find_modified_conffiles(self, sourcedir="/"):
-        dpkg_status = sourcedir+apt_pkg.config.find("Dir::State::status")
-        modified = set()
-        # iterate dpkg-status file
+    def _get_conffiles(self, dpkg_status):
+        """ return a list of (name, md5sum) of the not obsolete
+            conffiles in dpkg_status
+        """
+        conffiles = []
         with open(dpkg_status) as fp:
-            tag = apt_pkg.TagFile(fp)
-            for entry in tag:
-                if "conffiles" in entry:
-                    for line in entry["conffiles"].split("\n"):
-                        obsolete = None
-                        if len(line.split()) == 3:
-                            name, md5sum, obsolete = line.split()
-                        else:
-                            name, md5sum = line.split()
-                        # update
-                        path = sourcedir+name
-                        md5sum = md5sum.strip()
-                        # ignore oboslete conffiles
-                        if obsolete == "obsolete":
-                            continue
-                        # user removed conffile
-                        if not os.path.exists(path):
-                            logging.debug("conffile %s removed" % path)
-                            modified.add(path)
-                            continue
-                        # check content
-                        md5 = hashlib.md5()
-                        with open(path, 'rb') as fp:
-                            md5.update(fp.read())
-                        if md5.hexdigest() != md5sum:
-                            logging.debug("conffile %s (%s != %s)" % (
-                                    path, md5.hexdigest(), md5sum))
-                            modified.add(path)
+            for entry in apt_pkg.TagFile(fp):
+                if "conffiles" not in entry:
+                    continue
+                for line in entry["conffiles"].split("\n"):
+                    fields = line.split()
+                    if len(fields) < 2:
+                        continue
+                    # ignore oboslete conffiles
+                    if len(fields) > 2 and fields[2] == "obsolete":
+                        continue
+                    conffiles.append((fields[0], fields[1]))
+        return conffiles
+
+    def _check_conffile(self, path, md5sum, digest_cache=None):
+        """ return True if the conffile at path is modified or removed """
+        try:
+            if digest_cache is not None:
+                digest = digest_cache.get_md5(path)
+            else:
+                digest = _get_md5(path)
+        except (IOError, OSError) as e:
+            if e.errno == errno.ENOENT:
+                # user removed conffile
+                logging.debug("conffile %s removed" % path)
+                return True
+            logging.warning("can not read conffile '%s': %s" % (path, e))
+            return False
+        if digest != md5sum:
+            logging.debug("conffile %s (%s != %s)" % (path, digest, md5sum))
+            return True
+        return False
+
+    def _find_modified_conffiles(self, sourcedir="/", jobs=1,
+                                 digest_cache=None, dpkg_status=None):
+        """ return the set of paths of the modified (or removed)
+            conffiles, the files are hashed by up to "jobs" threads and
+            unchanged files are taken from the optional DigestCache
+        """
+        if dpkg_status is None:
+            dpkg_status = sourcedir+apt_pkg.config.find("Dir::State::status")
+        paths = []
+        md5sums = []
+        for name, md5sum in self._get_conffiles(dpkg_status):
+            paths.append(sourcedir+name)
+            md5sums.append(md5sum)
+        # hashlib releases the GIL while hashing, so threads are enough
+        with concurrent.futures.ThreadPoolExecutor(max(1, jobs)) as pool:
+            results = pool.map(self._check_conffile, paths, md5sums,
+                               [digest_cache] * len(paths))
+            modified = set(path for path, res in zip(paths, results) if res)
+        if digest_cache is not None:
+            digest_cache.save()
         return modified
 
     def _dump_debconf_database(self, sourcedir):
@@ -790,3 +3218,42 @@ class AptClone(object):
         #
         # restore from text with:
         #   ssh remotehost debconf-copydb pipe configdb --config=Name:pipe --config=Driver:Pipe
+
+
+def _simulate_restore_batch_worker(args):
+    """ simulate a chunk of statefiles in a multiprocessing worker """
+    cache_cls = args[0]
+    clone = AptClone(cache_cls=cache_cls)
+    return list(clone._simulate_restore_batch(*args[1:]))
+
+
+def _clone_many_worker(args):
+    """ clone a single root in a multiprocessing worker """
+    (cache_cls, sourcedir, target, kwargs) = args
+    start = time.time()
+    result = {"source": sourcedir}
+    try:
+        clone = AptClone(cache_cls=cache_cls)
+        result["target"] = clone.save_state(sourcedir, target, **kwargs)
+        if clone.not_downloadable:
+            result["not_downloadable"] = sorted(clone.not_downloadable)
+        if clone.repack_failed:
+            result["repack_failed"] = sorted(clone.repack_failed)
+    except Exception as e:
+        logging.exception("cloning %s failed" % sourcedir)
+        result["error"] = str(e)
+    result["seconds"] = round(time.time() - start, 3)
+    return result
+
+
+def _info_worker(statefile, clone=None):
+    """ return the info dict of a single clone file for info_many """
+    result = {"file": statefile}
+    try:
+        if clone is None:
+            clone = AptClone()
+        result.update(clone.get_info(statefile))
+    except Exception as e:
+        logging.warning("can not read '%s': %s" % (statefile, e))
+        result["error"] = str(e)
+    return result
@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+#
+# compare the write/read throughput and the size of the supported clone
+# file compressions on real clone files
+#
+# usage: PYTHONPATH=.. ./bench_compression.py [--threads N] clone.tar.gz ...
+
+from __future__ import print_function
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from apt_clone import (
+    COMPRESSION,
+    _find_program,
+    _open_compressed,
+    _open_decompressed,
+)
+
+
+def available(compression):
+    if compression == "zstd":
+        return _find_program("zstd") is not None
+    return True
+
+
+def bench(raw, compression, level, threads):
+    with tempfile.NamedTemporaryFile(
+            suffix=COMPRESSION[compression][0]) as target:
+        start = time.time()
+        with open(raw, "rb") as src, \
+                _open_compressed(target.name, compression,
+                                 level, threads) as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        write = time.time() - start
+        start = time.time()
+        with _open_decompressed(target.name) as src:
+            while src.read(1024 * 1024):
+                pass
+        read = time.time() - start
+        return os.path.getsize(target.name), write, read
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--level", type=int)
+    parser.add_argument("clonefile", nargs="+")
+    args = parser.parse_args()
+
+    print("%-40s %-6s %12s %10s %10s %10s" % (
+        "file", "codec", "size", "ratio", "write MB/s", "read MB/s"))
+    for clonefile in args.clonefile:
+        # the uncompressed tar is the input for all compressions
+        with tempfile.NamedTemporaryFile() as raw:
+            with _open_decompressed(clonefile) as src:
+                shutil.copyfileobj(src, raw, 1024 * 1024)
+            raw.flush()
+            raw_size = os.path.getsize(raw.name)
+            mb = raw_size / 1024.0 / 1024.0
+            for compression in sorted(COMPRESSION):
+                if not available(compression):
+                    print("%-40s %-6s (not available)" % (
+                        os.path.basename(clonefile), compression))
+                    continue
+                size, write, read = bench(
+                    raw.name, compression, args.level, args.threads)
+                print("%-40s %-6s %12i %10.3f %10.1f %10.1f" % (
+                    os.path.basename(clonefile), compression, size,
+                    float(size) / raw_size,
+                    mb / max(write, 1e-6), mb / max(read, 1e-6)))
@@ -0,0 +1,74 @@
+#!/usr/bin/python3
+#
+# benchmark the writing of installed.pkgs/foreign.pkgs for growing
+# (synthetic) package counts, the time per package and the peak memory
+# should stay (roughly) constant if the writer scales linearly
+#
+# usage: PYTHONPATH=.. ./bench_installed_pkgs.py [count ...]
+
+from __future__ import print_function
+
+import os
+import sys
+import tarfile
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from apt_clone import AptClone
+
+
+class FakeOrigin(object):
+    archive = "stable"
+    origin = "Debian"
+
+
+class FakeVersion(object):
+    downloadable = True
+    origins = [FakeOrigin()]
+
+    def __init__(self, version):
+        self.version = version
+
+
+class FakePackage(object):
+    is_installed = True
+
+    def __init__(self, i):
+        self.name = "package-%08i" % i
+        self.installed = self.candidate = FakeVersion("1.%i-1" % i)
+        self.is_auto_installed = bool(i % 2)
+
+
+class FakeCache(object):
+
+    def __init__(self, count):
+        self.count = count
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield FakePackage(i)
+
+
+def run(count):
+    clone = AptClone(cache_cls=lambda rootdir: FakeCache(count))
+    with tempfile.TemporaryFile() as fp:
+        with tarfile.open(fileobj=fp, mode="w:gz") as tar:
+            tracemalloc.start()
+            start = time.time()
+            clone._write_state_installed_pkgs("/", tar)
+            duration = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+    return duration, peak
+
+
+if __name__ == "__main__":
+    counts = [int(c) for c in sys.argv[1:]] or [
+        1000, 10000, 50000, 100000, 200000]
+    print("%10s %10s %14s %12s" % ("pkgs", "time (s)", "us/pkg", "peak (kB)"))
+    for count in counts:
+        duration, peak = run(count)
+        print("%10i %10.2f %14.2f %12i" % (
+            count, duration, duration * 1000000 / count, peak / 1024))
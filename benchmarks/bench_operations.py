@@ -0,0 +1,378 @@
+#!/usr/bin/python3
+#
+# time and memory-profile the public AptClone operations on synthetic
+# dpkg roots of configurable size. Every root gets a dpkg status with
+# that many packages, extended_states, conffiles (some modified), files
+# in /etc that no package owns, keyrings, a sources.list that points to
+# a local file:// repository with the downloadable packages and a
+# repack cache with fake debs for the ones that are not downloadable.
+#
+# The results are written as JSON, give an earlier result file with
+# --compare to see the change per operation.
+#
+# usage: PYTHONPATH=.. ./bench_operations.py [--packages N ...]
+#            [--output results.json] [--compare old-results.json]
+
+from __future__ import print_function
+
+import argparse
+import gzip
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+import apt
+import apt_pkg
+from apt_clone import AptClone, RepackCache, _apt_config_context
+
+
+CODENAME = "bench"
+
+
+def pkgname(i):
+    return "bench-pkg-%06i" % i
+
+
+def write_repo(repodir, count, arch, not_downloadable):
+    """ write a file:// repository with the Packages (and a Release) for
+        all packages that are not in not_downloadable
+    """
+    component = os.path.join(repodir, "dists", CODENAME, "main")
+    bindir = os.path.join(component, "binary-%s" % arch)
+    os.makedirs(bindir)
+    with io.StringIO() as packages:
+        for i in range(count):
+            if i in not_downloadable:
+                continue
+            packages.write(
+                "Package: %s\nVersion: 1.%i-1\nArchitecture: %s\n"
+                "Maintainer: Bench <bench@example.com>\n"
+                "Installed-Size: 10\nSection: misc\nPriority: optional\n"
+                "Filename: pool/main/%s_1.%i-1_%s.deb\nSize: 1000\n"
+                "SHA256: %s\n" % (
+                    pkgname(i), i, arch, pkgname(i), i, arch,
+                    hashlib.sha256(pkgname(i).encode()).hexdigest()))
+            if i % 10:
+                packages.write("Depends: %s\n" % pkgname(i - 1))
+            packages.write("Description: benchmark package %i\n\n" % i)
+        data = packages.getvalue().encode("utf-8")
+    with open(os.path.join(bindir, "Packages"), "wb") as fp:
+        fp.write(data)
+    with gzip.open(os.path.join(bindir, "Packages.gz"), "wb") as fp:
+        fp.write(data)
+    release = ("Origin: Bench\nLabel: Bench\nSuite: %s\nCodename: %s\n"
+               "Architectures: %s\nComponents: main\nSHA256:\n" % (
+                   CODENAME, CODENAME, arch))
+    for name in ("Packages", "Packages.gz"):
+        path = os.path.join(bindir, name)
+        with open(path, "rb") as fp:
+            digest = hashlib.sha256(fp.read()).hexdigest()
+        release += " %s %i main/binary-%s/%s\n" % (
+            digest, os.path.getsize(path), arch, name)
+    with open(os.path.join(repodir, "dists", CODENAME, "Release"), "w") as fp:
+        fp.write(release)
+
+
+def status_stanza(i, arch):
+    """ return the dpkg status stanza (without the empty line) """
+    stanza = ("Package: %s\nStatus: install ok installed\n"
+              "Priority: optional\nSection: misc\nInstalled-Size: 10\n"
+              "Maintainer: Bench <bench@example.com>\n"
+              "Architecture: %s\nVersion: 1.%i-1\n" % (pkgname(i), arch, i))
+    if i % 10:
+        stanza += "Depends: %s\n" % pkgname(i - 1)
+    return stanza + "Description: benchmark package %i\n" % i
+
+
+def write_root(rootdir, repodir, count, arch, not_downloadable,
+               extra_files, keyrings):
+    """ write a synthetic dpkg root with count installed packages """
+    for d in ("etc/apt/sources.list.d", "etc/apt/preferences.d",
+              "etc/apt/trusted.gpg.d", "etc/bench-unowned",
+              "var/lib/dpkg/info", "var/lib/dpkg/updates",
+              "var/lib/apt/lists/partial", "var/cache/apt/archives/partial",
+              "usr/bin"):
+        os.makedirs(os.path.join(rootdir, d))
+    with open(os.path.join(rootdir, "etc/apt/apt.conf"), "w") as fp:
+        fp.write("#clear Dpkg::Post-Invoke;\n#clear Dpkg::Pre-Invoke;\n"
+                 "#clear APT::Update;\n")
+    with open(os.path.join(rootdir, "etc/apt/sources.list"), "w") as fp:
+        fp.write("deb [trusted=yes] file://%s %s main\n" % (
+            repodir, CODENAME))
+    with open(os.path.join(rootdir, "etc/apt/preferences"), "w") as fp:
+        fp.write("Package: %s\nPin: version *\nPin-Priority: 500\n" %
+                 pkgname(0))
+    for i in range(keyrings):
+        with open(os.path.join(
+                rootdir, "etc/apt/trusted.gpg.d/bench-%i.gpg" % i),
+                "wb") as fp:
+            fp.write(os.urandom(2048))
+    for i in range(extra_files):
+        with open(os.path.join(
+                rootdir, "etc/bench-unowned/file-%i.conf" % i), "w") as fp:
+            fp.write("setting = %i\n" % i)
+    status = open(os.path.join(rootdir, "var/lib/dpkg/status"), "w")
+    extended_states = open(os.path.join(
+        rootdir, "var/lib/apt/extended_states"), "w")
+    with status, extended_states:
+        for i in range(count):
+            name = pkgname(i)
+            files = ["/usr/share/doc/%s/copyright" % name]
+            conffile = None
+            # every 50th package has a conffile, every 4th of those
+            # is modified
+            if i % 50 == 0:
+                conffile = "/etc/%s.conf" % name
+                content = "option = %i\n" % i
+                md5 = hashlib.md5(content.encode()).hexdigest()
+                if i % 200 == 0:
+                    content += "# changed\n"
+                with open(os.path.join(rootdir, conffile[1:]), "w") as fp:
+                    fp.write(content)
+                files.append(conffile)
+            with open(os.path.join(
+                    rootdir, "var/lib/dpkg/info/%s.list" % name), "w") as fp:
+                fp.write("\n".join(files) + "\n")
+            status.write(status_stanza(i, arch))
+            if conffile:
+                status.write("Conffiles:\n %s %s\n" % (conffile, md5))
+            status.write("\n")
+            if i % 3:
+                extended_states.write(
+                    "Package: %s\nArchitecture: %s\nAuto-Installed: 1\n\n" %
+                    (name, arch))
+
+
+def write_repack_cache(cachedir, rootdir, arch, not_downloadable):
+    """ put fake debs for the not downloadable packages into a
+        RepackCache so that no dpkg-repack is needed
+    """
+    repack_cache = RepackCache(cachedir)
+    debdir = tempfile.mkdtemp()
+    with _apt_config_context():
+        apt_pkg.config.set("Dir", rootdir)
+        apt_pkg.config.set("Dir::State::status",
+                           os.path.join(rootdir, "var/lib/dpkg/status"))
+        for i in sorted(not_downloadable):
+            deb = os.path.join(debdir, "%s_1.%i-1_%s.deb" % (
+                pkgname(i), i, arch))
+            with open(deb, "wb") as fp:
+                fp.write(os.urandom(16 * 1024))
+            repack_cache.put(repack_cache.get_key(
+                pkgname(i), "1.%i-1" % i, arch), [deb])
+            os.remove(deb)
+    os.rmdir(debdir)
+
+
+def update_lists(rootdir):
+    """ fetch the lists of the file:// repository into the root """
+    with _apt_config_context():
+        cache = apt.Cache(rootdir=rootdir)
+        cache.update(apt.progress.base.AcquireProgress())
+
+
+def setup(workdir, count, extra_files, keyrings, repack_ratio):
+    arch = apt_pkg.config.find("APT::Architecture")
+    step = int(1 / repack_ratio) if repack_ratio else 0
+    not_downloadable = set(range(step - 1, count, step)) if step else set()
+    ctx = {"workdir": workdir,
+           "root": os.path.join(workdir, "root"),
+           "repo": os.path.join(workdir, "repo"),
+           "repack_cache": os.path.join(workdir, "repack-cache"),
+           }
+    # the second clone has some more packages installed
+    more = max(1, count // 100)
+    write_repo(ctx["repo"], count + more, arch, not_downloadable)
+    write_root(ctx["root"], ctx["repo"], count, arch, not_downloadable,
+               extra_files, keyrings)
+    write_repack_cache(ctx["repack_cache"], ctx["root"], arch,
+                       not_downloadable)
+    update_lists(ctx["root"])
+    ctx["lists"] = os.path.join(ctx["root"], "var/lib/apt/lists")
+    # the clone files the read-only operations work on
+    clone = new_clone()
+    ctx["base"] = clone.save_state(
+        ctx["root"], os.path.join(workdir, "base"), fast=True)
+    with open(os.path.join(ctx["root"], "var/lib/dpkg/status"), "a") as fp:
+        for i in range(count, count + more):
+            fp.write(status_stanza(i, arch) + "\n")
+    ctx["clone"] = clone.save_state(
+        ctx["root"], os.path.join(workdir, "clone"), fast=True,
+        with_modified_conffiles=True, with_unowned_files=True)
+    ctx["delta"] = clone.save_state(
+        ctx["root"], os.path.join(workdir, "delta"), fast=True,
+        base=ctx["base"])
+    return ctx
+
+
+def new_clone():
+    return AptClone(fetch_progress=apt.progress.base.AcquireProgress())
+
+
+def output(ctx, name):
+    return os.path.join(ctx["workdir"], "out", name)
+
+
+# the benchmarked operations, restore_state is not included as it needs
+# root and a chroot
+OPERATIONS = {
+    "save_state": lambda clone, ctx: clone.save_state(
+        ctx["root"], output(ctx, "full")),
+    "save_state_fast": lambda clone, ctx: clone.save_state(
+        ctx["root"], output(ctx, "fast"), fast=True),
+    "save_state_everything": lambda clone, ctx: clone.save_state(
+        ctx["root"], output(ctx, "everything"), with_dpkg_repack=True,
+        with_dpkg_status=True, with_lists=True,
+        with_modified_conffiles=True, with_unowned_files=True,
+        repack_cache=RepackCache(ctx["repack_cache"])),
+    "save_state_delta": lambda clone, ctx: clone.save_state(
+        ctx["root"], output(ctx, "delta"), fast=True, base=ctx["base"]),
+    "compact": lambda clone, ctx: clone.compact(
+        ctx["delta"], output(ctx, "compact.tar.gz")),
+    "info": lambda clone, ctx: clone.info(ctx["clone"]),
+    "get_package_set": lambda clone, ctx: clone.get_package_set(
+        ctx["clone"]),
+    "show_diff": lambda clone, ctx: clone.get_diff(
+        ctx["base"], ctx["root"]),
+    "diff_clones": lambda clone, ctx: clone.diff_clones(
+        ctx["base"], ctx["clone"]),
+    "check_availability": lambda clone, ctx: clone.check_availability(
+        ctx["clone"], [os.path.join(ctx["repo"], "dists")]),
+    "simulate_restore_state": lambda clone, ctx:
+        clone.simulate_restore_state(ctx["clone"], None),
+    "simulate_restore_state_offline": lambda clone, ctx:
+        clone.simulate_restore_state(
+            ctx["clone"], None, offline=True, lists_dir=ctx["lists"]),
+}
+
+
+def run_once(name, ctx):
+    outdir = os.path.join(ctx["workdir"], "out")
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+    clone = new_clone()
+    start = time.time()
+    OPERATIONS[name](clone, ctx)
+    return time.time() - start
+
+
+def profile_memory(name, ctx, queue):
+    """ run the operation in a forked process and report the python
+        peak (tracemalloc) and the peak rss of that process
+    """
+    tracemalloc.start()
+    run_once(name, ctx)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    queue.put((peak, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+
+def bench(name, ctx, repeat):
+    seconds = [run_once(name, ctx) for i in range(repeat)]
+    mp = multiprocessing.get_context("fork")
+    queue = mp.Queue()
+    proc = mp.Process(target=profile_memory, args=(name, ctx, queue))
+    proc.start()
+    peak, maxrss = queue.get()
+    proc.join()
+    return {"seconds": [round(s, 4) for s in seconds],
+            "min_seconds": round(min(seconds), 4),
+            "python_peak_kb": peak // 1024,
+            "max_rss_kb": maxrss,
+            }
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], universal_newlines=True,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    print("%-32s %10s %12s %12s %8s" % (
+        "operation", "packages", "old (s)", "new (s)", "change"))
+    for count, results in sorted(new["results"].items(), key=lambda r:
+                                 int(r[0])):
+        for name, result in sorted(results.items()):
+            old_result = old["results"].get(count, {}).get(name)
+            if old_result is None:
+                continue
+            a = old_result["min_seconds"]
+            b = result["min_seconds"]
+            print("%-32s %10s %12.4f %12.4f %+7.1f%%" % (
+                name, count, a, b, (b - a) * 100.0 / max(a, 1e-6)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packages", type=int, nargs="+", default=[5000],
+                        help="number of installed packages (default: 5000)")
+    parser.add_argument("--extra-files", type=int, default=100,
+                        help="number of unowned files in /etc")
+    parser.add_argument("--keyrings", type=int, default=5)
+    parser.add_argument("--repack-ratio", type=float, default=0.01,
+                        help="part of the packages that is not downloadable")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--operation", action="append",
+                        choices=sorted(OPERATIONS),
+                        help="only run this operation (can be repeated)")
+    parser.add_argument("--workdir",
+                        help="keep the generated roots in this dir")
+    parser.add_argument("--output", help="write the JSON results here")
+    parser.add_argument("--compare", help="earlier JSON results")
+    args = parser.parse_args()
+
+    result = {"commit": get_commit(),
+              "date": int(time.time()),
+              "python": platform.python_version(),
+              "apt": apt_pkg.VERSION,
+              "machine": platform.machine(),
+              "cpus": os.cpu_count(),
+              "scale": {"extra_files": args.extra_files,
+                        "keyrings": args.keyrings,
+                        "repack_ratio": args.repack_ratio},
+              "results": {},
+              }
+    for count in args.packages:
+        workdir = tempfile.mkdtemp(
+            prefix="bench-%i-" % count, dir=args.workdir)
+        try:
+            start = time.time()
+            ctx = setup(workdir, count, args.extra_files, args.keyrings,
+                        args.repack_ratio)
+            print("%i packages: setup took %.1fs" % (
+                count, time.time() - start), file=sys.stderr)
+            results = result["results"][str(count)] = {}
+            for name in args.operation or sorted(OPERATIONS):
+                results[name] = bench(name, ctx, args.repeat)
+                print("%-32s %10.4fs %10i kB" % (
+                    name, results[name]["min_seconds"],
+                    results[name]["max_rss_kb"]), file=sys.stderr)
+        finally:
+            if args.workdir is None:
+                shutil.rmtree(workdir)
+    data = json.dumps(result, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as fp:
+            fp.write(data + "\n")
+    else:
+        print(data)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp), result)
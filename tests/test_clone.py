@@ -4,17 +4,33 @@ from __future__ import print_function
 
 import apt
 import apt_pkg
+import errno
+import gzip
+import json
 import mock
 import os
 import shutil
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import unittest
 import distro_info
 
+from io import BytesIO
+
 sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
-from apt_clone import AptClone
+import apt_clone
+from apt_clone import (
+    AptClone,
+    ClonePackageSet,
+    DigestCache,
+    FleetIndex,
+    OwnershipIndex,
+    RepackCache,
+    StateArchive,
+)
 
 
 class MockAptCache(apt.Cache):
@@ -90,6 +106,215 @@ class TestClone(unittest.TestCase):
                 ['./etc/apt/sources.list.d',
                  './etc/apt/sources.list.d/ubuntu-mozilla-daily-ppa-maverick.list']))
 
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_fast(self, mock_lowlevel):
+        sourcedir = "./data/mock-system"
+        installed = {}
+        for fast in (False, True):
+            clone = AptClone(cache_cls=MockAptCache)
+            target = os.path.join(self.tempdir, "fast-%s" % fast)
+            clone.save_state(sourcedir, target, fast=fast)
+            with tarfile.open(target + ".apt-clone.tar.gz") as tar:
+                installed[fast] = tar.extractfile(
+                    "./var/lib/apt-clone/installed.pkgs").read()
+        self.assertNotEqual(installed[True], b"")
+        self.assertEqual(installed[True], installed[False])
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_compression(self, mock_lowlevel):
+        sourcedir = "./data/mock-system"
+        for compression, threads, suffix in [("xz", 1, ".tar.xz"),
+                                             ("xz", 2, ".tar.xz"),
+                                             ("none", 1, ".tar"),
+                                             ("gzip", 1, ".tar.gz")]:
+            clone = AptClone(cache_cls=MockAptCache)
+            target = os.path.join(self.tempdir, "%s-%s" % (compression, threads))
+            clone.save_state(sourcedir, target, fast=True,
+                             compression=compression,
+                             compression_threads=threads)
+            target += ".apt-clone" + suffix
+            self.assertTrue(os.path.exists(target))
+            # the readers detect the compression
+            self.assertTrue("Installed: 1 pkgs" in clone.info(target))
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_stores_compressed_payloads(self, mock_lowlevel):
+        def repack_deb(pkgname, targetdir):
+            with open(os.path.join(targetdir, pkgname + ".deb"), "wb") as fp:
+                fp.write(b"!<arch>\ndebian-binary" + b"x" * 1000)
+            return True
+        # a already compressed and a plain extra file
+        extra = os.path.join(self.tempdir, "extra")
+        os.makedirs(extra)
+        with gzip.open(os.path.join(extra, "blob.gz"), "wb") as fp:
+            fp.write(b"compressed" * 1000)
+        with open(os.path.join(extra, "plain.txt"), "w") as fp:
+            fp.write("plain" * 1000)
+        clone = AptClone(cache_cls=MockAptCache)
+        clone.commands.repack_deb.side_effect = repack_deb
+        target = os.path.join(self.tempdir, "payloads")
+        # a plain clone file stays a gzip compressed tar
+        plain_target = clone.save_state(
+            "./data/mock-system", os.path.join(self.tempdir, "plain"),
+            with_dpkg_repack=True, extra_files=[os.path.join(extra, "*")])
+        self.assertTrue(plain_target.endswith(".apt-clone.tar.gz"))
+        with tarfile.open(plain_target, "r:gz") as tar:
+            plain = tar.getmember(
+                "./extra-files" + os.path.join(extra, "plain.txt"))
+            self.assertFalse("APT-CLONE.compression" in plain.pax_headers)
+        target = clone.save_state("./data/mock-system", target,
+                                  with_dpkg_repack=True, seekable=True,
+                                  extra_files=[os.path.join(extra, "*")])
+        self.assertTrue(target.endswith(".apt-clone.tar"))
+        # the tar itself is not compressed
+        with tarfile.open(target, "r:") as tar:
+            members = dict((m.name, m) for m in tar.getmembers())
+        deb = members["./var/lib/apt-clone/debs/2vcard.deb"]
+        self.assertEqual(deb.pax_headers.get("APT-CLONE.compression"), None)
+        blob = members["./extra-files" + os.path.join(extra, "blob.gz")]
+        self.assertEqual(blob.pax_headers.get("APT-CLONE.compression"), None)
+        plain = members["./extra-files" + os.path.join(extra, "plain.txt")]
+        self.assertEqual(
+            plain.pax_headers.get("APT-CLONE.compression"), "gzip")
+        self.assertTrue(plain.size < 5000)
+        # but reading it is transparent
+        with StateArchive(target) as archive:
+            self.assertEqual(
+                archive.read("extra-files" + os.path.join(extra, "plain.txt")),
+                b"plain" * 1000)
+            restoredir = os.path.join(self.tempdir, "restore")
+            clone._restore_extra_files(archive, restoredir)
+        with open(os.path.join(restoredir, extra[1:], "plain.txt")) as fp:
+            self.assertEqual(fp.read(), "plain" * 1000)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_manifest(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = os.path.join(self.tempdir, "manifest")
+        clone.save_state("./data/mock-system", target)
+        target += ".apt-clone.tar.gz"
+        with tarfile.open(target) as tar:
+            self.assertEqual(
+                tar.getnames()[0], "./var/lib/apt-clone/manifest")
+        manifest = apt_pkg.TagSection(clone._read_manifest(target))
+        self.assertEqual(manifest["Installed"], "1")
+        self.assertTrue(manifest["Packages-Digest"].startswith("sha256:"))
+        # info uses the manifest only
+        with mock.patch("apt_clone.StateArchive.__init__",
+                        side_effect=AssertionError("archive opened")):
+            info = clone.info(target)
+        self.assertTrue("Installed: 1 pkgs (0 automatic)" in info)
+        # old clone files without manifest still work
+        self.assertEqual(
+            clone._read_manifest("./data/apt-state.tar.gz"), None)
+        self.assertTrue("Distro: natty" in clone.info("./data/apt-state.tar.gz"))
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_info_many(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state("./data/mock-system",
+                                  os.path.join(self.tempdir, "info"))
+        statefiles = [target, "./data/apt-state.tar.gz",
+                      os.path.join(self.tempdir, "missing.tar.gz")]
+        results = list(clone.info_many(statefiles, jobs=2))
+        self.assertEqual([r["file"] for r in results], statefiles)
+        self.assertEqual(results[0]["installed"], 1)
+        self.assertEqual(results[0]["meta"], [])
+        self.assertTrue(isinstance(results[0]["date"], int))
+        self.assertEqual(results[1]["distro"], "natty")
+        self.assertTrue("error" in results[2])
+        json.dumps(results)
+        # clone files with manifest are not opened as archive
+        with mock.patch("apt_clone.StateArchive.__init__",
+                        side_effect=AssertionError("archive opened")):
+            results = list(clone.info_many(statefiles[:1]))
+        self.assertEqual(results[0]["hostname"], os.uname()[1])
+        self.assertEqual(clone.format_info(results[0]), clone.info(target))
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_seekable(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = os.path.join(self.tempdir, "seekable")
+        clone.save_state("./data/mock-system", target, seekable=True)
+        target += ".apt-clone.tar"
+        with StateArchive(target) as archive:
+            # the index is used, nothing is read before it is needed
+            self.assertTrue(all(isinstance(m, int)
+                                for m in archive._members.values()))
+            self.assertEqual(
+                archive.read("var/lib/apt-clone/installed.pkgs"),
+                b"2vcard 0.5-3 0\n")
+            restoredir = os.path.join(self.tempdir, "restore")
+            clone._restore_sources_list(archive, restoredir)
+        self.assertTrue(os.path.exists(os.path.join(
+            restoredir, "etc/apt/sources.list.d/"
+            "ubuntu-mozilla-daily-ppa-maverick.list")))
+        # uncompressed clone files without index are not searched for one
+        plain = clone.save_state("./data/mock-system", target + "-plain",
+                                 compression="none")
+        with mock.patch.object(StateArchive, "_read_index") as mock_index:
+            with StateArchive(plain) as archive:
+                self.assertEqual(
+                    archive.read("var/lib/apt-clone/installed.pkgs"),
+                    b"2vcard 0.5-3 0\n")
+        self.assertFalse(mock_index.called)
+
+    def test_dpkg_repack_parallel(self):
+        def repack_deb(pkgname, targetdir):
+            if pkgname == "broken":
+                return False
+            with open(os.path.join(targetdir, pkgname + ".deb"), "w"):
+                pass
+            return True
+        clone = AptClone()
+        clone.commands = mock.Mock()
+        clone.commands.repack_deb.side_effect = repack_deb
+        clone.not_downloadable = set(["foo", "bar", "broken", "baz"])
+        tarname = os.path.join(self.tempdir, "repack.tar")
+        with tarfile.open(tarname, "w") as tar:
+            clone._dpkg_repack(tar, jobs=3)
+        self.assertEqual(clone.repack_failed, {"broken": "dpkg-repack failed"})
+        with tarfile.open(tarname) as tar:
+            members = [m.name for m in tar.getmembers()]
+            failed = tar.extractfile(
+                "./var/lib/apt-clone/repack-failed.pkgs").read()
+        self.assertEqual(
+            [m for m in members if m.endswith(".deb")],
+            ["./var/lib/apt-clone/debs/%s.deb" % p
+             for p in ("bar", "baz", "foo")])
+        self.assertEqual(failed, b"broken dpkg-repack failed\n")
+
+    def test_dpkg_repack_cache(self):
+        def repack_deb(pkgname, targetdir):
+            with open(os.path.join(targetdir, pkgname + ".deb"), "w") as fp:
+                fp.write("x" * 100)
+            return True
+        apt_pkg.config.set(
+            "Dir::state::status", "./data/mock-system/var/lib/dpkg/status")
+        cache = RepackCache(os.path.join(self.tempdir, "cache"), max_size=150)
+        for i in range(2):
+            clone = AptClone()
+            clone.commands = mock.Mock()
+            clone.commands.repack_deb.side_effect = repack_deb
+            clone.not_downloadable = set(["2vcard"])
+            clone._not_downloadable_versions = {"2vcard": ("0.5-1", "all")}
+            tarname = os.path.join(self.tempdir, "repack-%i.tar" % i)
+            with tarfile.open(tarname, "w") as tar:
+                clone._dpkg_repack(tar, repack_cache=cache)
+            with tarfile.open(tarname) as tar:
+                self.assertTrue(
+                    "./var/lib/apt-clone/debs/2vcard.deb" in tar.getnames())
+            # only the first run needs to repack
+            self.assertEqual(clone.commands.repack_deb.called, i == 0)
+        # a changed version is a cache miss and the old entry gets expired
+        key = cache.get_key("2vcard", "0.5-2", "all")
+        newdir = os.path.join(self.tempdir, "new")
+        os.makedirs(newdir)
+        repack_deb("2vcard", newdir)
+        cache.put(key, [os.path.join(newdir, "2vcard.deb")])
+        cache.expire()
+        self.assertEqual(os.listdir(cache.cachedir), [key])
+
     @mock.patch("apt_clone.LowLevelCommands")
     def test_restore_state(self, mock_lowlevel):
         # setup mock
@@ -97,10 +322,72 @@ class TestClone(unittest.TestCase):
         targetdir = self.tempdir
         # test
         clone = AptClone(cache_cls=MockAptCache)
-        clone.restore_state(
-            "./data/apt-state_chroot_with_vim.tar.gz", targetdir)
+        with mock.patch.object(
+                clone, "_restore_modified_conffiles") as mock_conffiles:
+            clone.restore_state(
+                "./data/apt-state_chroot_with_vim.tar.gz", targetdir)
         self.assertTrue(
             os.path.exists(os.path.join(targetdir, "etc","apt","sources.list")))
+        # the modified conffiles are only restored on request
+        self.assertFalse(mock_conffiles.called)
+        with mock.patch.object(
+                clone, "_restore_modified_conffiles") as mock_conffiles:
+            clone.restore_state(
+                "./data/apt-state_chroot_with_vim.tar.gz", targetdir,
+                with_modified_conffiles=True)
+        self.assertTrue(mock_conffiles.called)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_restore_state_lists_from_clone(self, mock_lowlevel):
+        mock_lowlevel.install_debs.return_value = True
+        system = os.path.join(self.tempdir, "system")
+        shutil.copytree("./data/mock-system", system)
+        lists = os.path.join(system, "var/lib/apt/lists")
+        for name in ("example.com_ubuntu_dists_lucid_InRelease",
+                     "example.com_ubuntu_dists_lucid_main_binary-all_Packages",
+                     "lock"):
+            with open(os.path.join(lists, name), "w") as fp:
+                fp.write("\n")
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state(
+            system, os.path.join(self.tempdir, "clone"), fast=True,
+            with_lists=True)
+        with StateArchive(target) as archive:
+            self.assertEqual(
+                [m.name for m in archive.getmembers_under(
+                    "var/lib/apt-clone/lists")],
+                ["./var/lib/apt-clone/lists/"
+                 "example.com_ubuntu_dists_lucid_InRelease",
+                 "./var/lib/apt-clone/lists/"
+                 "example.com_ubuntu_dists_lucid_main_binary-all_Packages"])
+        # the lists of the clone are used without updating them
+        targetdir = os.path.join(self.tempdir, "target")
+        os.makedirs(targetdir)
+        with mock.patch.object(MockAptCache, "update") as mock_update:
+            clone.restore_state(target, targetdir, lists_from_clone=True)
+        self.assertFalse(mock_update.called)
+        self.assertTrue(os.path.exists(os.path.join(
+            targetdir, "var/lib/apt/lists",
+            "example.com_ubuntu_dists_lucid_InRelease")))
+        # unless they are too old
+        for name in os.listdir(os.path.join(targetdir, "var/lib/apt/lists")):
+            path = os.path.join(targetdir, "var/lib/apt/lists", name)
+            os.utime(path, (time.time() - 3600, time.time() - 3600))
+        with mock.patch.object(MockAptCache, "update") as mock_update:
+            clone.restore_state(target, targetdir, lists_max_age=60)
+        self.assertTrue(mock_update.called)
+        with mock.patch.object(MockAptCache, "update") as mock_update:
+            clone.restore_state(target, targetdir, lists_max_age=7200)
+        self.assertFalse(mock_update.called)
+        # the simulation can use them as well
+        with mock.patch.object(MockAptCache, "update") as mock_update:
+            clone.simulate_restore_state(target, None, lists_from_clone=True)
+        self.assertFalse(mock_update.called)
+        # but not for a new distro, apt would have no candidates
+        self.assertRaises(ValueError, clone.restore_state, target, targetdir,
+                          new_distro="maverick", lists_from_clone=True)
+        self.assertRaises(ValueError, clone.simulate_restore_state, target,
+                          None, "maverick", lists_from_clone=True)
 
     @mock.patch("apt_clone.LowLevelCommands")
     def test_restore_state_with_not_downloadable_debs(self, mock_lowlevel):
@@ -137,10 +424,14 @@ class TestClone(unittest.TestCase):
             fp.write(s.encode("utf-8"))
         # test upgrade clone from lucid system to maverick
         clone = AptClone(cache_cls=MockAptCache)
-        clone.restore_state(
-            "./data/apt-state-ubuntu-lucid.tar.gz",
-            targetdir,
-            new_distro="maverick")
+        with mock.patch.object(
+                clone, "_restore_modified_conffiles") as mock_conffiles:
+            clone.restore_state(
+                "./data/apt-state-ubuntu-lucid.tar.gz",
+                targetdir,
+                new_distro="maverick", with_modified_conffiles=True)
+        # the conffiles of the old release are not restored
+        self.assertFalse(mock_conffiles.called)
         sources_list = os.path.join(targetdir, "etc","apt","sources.list")
         self.assertTrue(os.path.exists(sources_list))
         with open(sources_list) as fp:
@@ -156,6 +447,93 @@ class TestClone(unittest.TestCase):
         # missing, because clone does not have universe enabled
         self.assertEqual(list(missing), ['accerciser'])
 
+    def _make_offline_clone(self, name, installed):
+        """ return a clone file with installed as installed.pkgs and the
+            lists dir with the package "foo" that matches its sources
+        """
+        arch = apt_pkg.config.find("APT::Architecture")
+        lists = os.path.join(self.tempdir, "lists")
+        if not os.path.exists(lists):
+            os.makedirs(lists)
+        with open(os.path.join(
+                lists, "example.com_ubuntu_dists_lucid_main_binary-%s_Packages"
+                % arch), "w") as fp:
+            fp.write("Package: foo\nVersion: 1.0\nArchitecture: all\n"
+                     "Filename: pool/main/f/foo/foo_1.0_all.deb\n"
+                     "Size: 100\nDescription: foo\n foo\n")
+        state = os.path.join(self.tempdir, name)
+        os.makedirs(os.path.join(state, "etc/apt"))
+        os.makedirs(os.path.join(state, "var/lib/apt-clone"))
+        with open(os.path.join(state, "etc/apt/sources.list"), "w") as fp:
+            fp.write("deb [trusted=yes] http://example.com/ubuntu lucid main\n")
+        with open(os.path.join(
+                state, "var/lib/apt-clone/installed.pkgs"), "w") as fp:
+            fp.write(installed)
+        statefile = os.path.join(self.tempdir, name + ".tar.gz")
+        with tarfile.open(statefile, "w:gz") as tar:
+            tar.add(os.path.join(state, "etc"), arcname="./etc")
+            tar.add(os.path.join(state, "var"), arcname="./var")
+        return statefile, lists
+
+    def test_restore_state_simulate_offline(self):
+        statefile, lists = self._make_offline_clone(
+            "clone", "foo 1.0 0\nbar 1.0 0\n")
+        # the lists are linked into the root, not downloaded
+        clone = AptClone()
+        with mock.patch("apt.Cache.update") as mock_update:
+            missing = clone.simulate_restore_state(
+                statefile, [], offline=True, lists_dir=lists)
+        self.assertFalse(mock_update.called)
+        self.assertEqual(missing, set(["bar"]))
+        root = os.path.join(self.tempdir, "root")
+        apt_clone._seed_lists(lists, root)
+        name = os.listdir(lists)[0]
+        self.assertEqual(
+            os.stat(os.path.join(lists, name)).st_ino,
+            os.stat(os.path.join(root, "var/lib/apt/lists", name)).st_ino)
+
+    def test_simulate_restore_batch(self):
+        statefiles = []
+        for i, installed in enumerate(["foo 1.0 0\nbar 1.0 0\n",
+                                       "foo 1.0 1\n",
+                                       "baz 1.0 0\n"]):
+            statefile, lists = self._make_offline_clone(
+                "clone%i" % i, installed)
+            statefiles.append(statefile)
+        expected = {statefiles[0]: set(["bar"]),
+                    statefiles[1]: set(),
+                    statefiles[2]: set(["baz"])}
+        clone = AptClone()
+        # the cache is only opened once
+        with mock.patch.object(
+                AptClone, "_open_simulate_cache",
+                side_effect=AptClone._open_simulate_cache,
+                autospec=True) as mock_open_cache:
+            results = list(clone.simulate_restore_batch(
+                statefiles, offline=True, lists_dir=lists))
+        self.assertEqual(mock_open_cache.call_count, 1)
+        self.assertEqual(
+            dict((f, missing) for (f, missing, error) in results), expected)
+        # same with more processes
+        results = list(clone.simulate_restore_batch(
+            statefiles, offline=True, lists_dir=lists, jobs=2))
+        self.assertEqual(
+            dict((f, missing) for (f, missing, error) in results), expected)
+        # the config is only taken between the yields
+        def try_lock(acquired):
+            if apt_clone._apt_config_lock.acquire(blocking=False):
+                apt_clone._apt_config_lock.release()
+                acquired.append(True)
+        dir_before = apt_pkg.config.find("Dir")
+        for result in clone.simulate_restore_batch(
+                statefiles, offline=True, lists_dir=lists):
+            self.assertEqual(apt_pkg.config.find("Dir"), dir_before)
+            acquired = []
+            t = threading.Thread(target=try_lock, args=(acquired,))
+            t.start()
+            t.join()
+            self.assertEqual(acquired, [True])
+
     def test_restore_state_simulate_with_new_release(self):
         #apt_pkg.config.set("Debug::PkgProblemResolver", "1")
         apt_pkg.config.set(
@@ -167,12 +545,496 @@ class TestClone(unittest.TestCase):
         # FIXME: check that the stuff in missing is ok
         #print(missing)
 
+    def test_state_archive(self):
+        with StateArchive("./data/apt-state_with_not_downloadable_debs.tar.gz") as archive:
+            self.assertEqual(archive.prefix, "./")
+            self.assertTrue("etc/apt/sources.list" in archive)
+            self.assertTrue("./etc/apt/sources.list" in archive)
+            self.assertFalse("etc/apt/no-such-file" in archive)
+            self.assertEqual(
+                [archive._normalize(m.name) for m in
+                 archive.getmembers_under("var/lib/apt-clone/debs")],
+                ["var/lib/apt-clone/debs/foo.deb"])
+            # the same archive object can be handed to the helpers
+            info = AptClone().info(archive)
+        self.assertTrue("Distro: lucid" in info)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_get_diff(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state(
+            "./data/mock-system", self.tempdir, fast=True)
+        # no apt cache is needed for the diff
+        with mock.patch.object(clone, "_cache_cls") as mock_cache:
+            diff = clone.get_diff(target, "./data/mock-system")
+        self.assertFalse(mock_cache.called)
+        self.assertEqual(diff["sources"], {})
+        self.assertEqual(
+            diff["keyrings"],
+            {"only_in_clone": [], "only_on_system": [], "changed": []})
+        self.assertEqual(
+            diff["packages"],
+            {"only_on_system": [], "only_in_clone": [],
+             "version_differences": [], "auto_differences": []})
+        # now change the system
+        system = os.path.join(self.tempdir, "system")
+        shutil.copytree("./data/mock-system", system)
+        status = os.path.join(system, "var/lib/dpkg/status")
+        with open(status) as fp:
+            data = fp.read()
+        with open(status, "w") as fp:
+            fp.write(data.replace("Version: 0.5-3", "Version: 0.5-4"))
+            fp.write("\nPackage: foo\nStatus: install ok installed\n"
+                     "Architecture: all\nVersion: 1.0\n")
+        os.remove(os.path.join(
+            system,
+            "etc/apt/sources.list.d/ubuntu-mozilla-daily-ppa-maverick.list"))
+        with open(os.path.join(system, "etc/apt/trusted.gpg"), "ab") as fp:
+            fp.write(b"x")
+        diff = clone.get_diff(target, system)
+        self.assertEqual(
+            list(diff["sources"]),
+            ["/etc/apt/sources.list.d/ubuntu-mozilla-daily-ppa-maverick.list"])
+        self.assertEqual(diff["keyrings"]["changed"], ["/etc/apt/trusted.gpg"])
+        self.assertEqual(diff["packages"]["only_on_system"], ["foo"])
+        self.assertEqual(
+            diff["packages"]["version_differences"],
+            [("2vcard", "0.5-3", "0.5-4")])
+        # and the json output
+        with mock.patch("sys.stdout") as mock_stdout:
+            clone.show_diff(target, system, format="json")
+        output = "".join(c[0][0] for c in mock_stdout.write.call_args_list)
+        self.assertEqual(
+            json.loads(output)["packages"]["only_on_system"], ["foo"])
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_diff_clones(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        system = os.path.join(self.tempdir, "system")
+        shutil.copytree("./data/mock-system", system)
+        old = clone.save_state(
+            system, os.path.join(self.tempdir, "old"), fast=True)
+        status = os.path.join(system, "var/lib/dpkg/status")
+        with open(status) as fp:
+            data = fp.read()
+        with open(status, "w") as fp:
+            fp.write(data.replace("Version: 0.5-3", "Version: 0.5-4"))
+            fp.write("\nPackage: foo\nStatus: install ok installed\n"
+                     "Architecture: all\nVersion: 1.0\n")
+        with open(os.path.join(system, "etc/apt/sources.list"), "a") as fp:
+            fp.write("deb http://example.com/ubuntu natty main\n")
+        os.remove(os.path.join(system, "etc/apt/preferences"))
+        new = clone.save_state(
+            system, os.path.join(self.tempdir, "new"), fast=True)
+        # no system (and no apt cache) is looked at
+        with mock.patch.object(clone, "_cache_cls") as mock_cache:
+            diff = clone.diff_clones(old, new)
+        self.assertFalse(mock_cache.called)
+        self.assertEqual(diff["info"]["installed"], {"old": 1, "new": 2})
+        self.assertEqual(
+            diff["packages"],
+            {"added": ["foo"], "removed": [],
+             "version_changes": [("2vcard", "0.5-3", "0.5-4")],
+             "auto_changes": []})
+        self.assertEqual(
+            diff["files"],
+            {"added": [], "removed": ["/etc/apt/preferences"],
+             "changed": ["/etc/apt/sources.list"]})
+        self.assertTrue(
+            "+deb http://example.com/ubuntu natty main\n" in
+            diff["sources"]["/etc/apt/sources.list"])
+        # the other way round
+        diff = clone.diff_clones(new, old)
+        self.assertEqual(diff["packages"]["removed"], ["foo"])
+        self.assertEqual(diff["files"]["added"], ["/etc/apt/preferences"])
+
+    def test_clone_package_set(self):
+        pkgs = ClonePackageSet.from_file(BytesIO(
+            b"zsh 5.0 0\nbash 4.1 0\n\nlibc6 2.11 1\nlibc6:i386 2.11 1\n"))
+        self.assertEqual(len(pkgs), 4)
+        self.assertEqual(
+            pkgs.names(), ["bash", "libc6", "libc6:i386", "zsh"])
+        self.assertEqual(pkgs.auto_count(), 2)
+        self.assertTrue("libc6:i386" in pkgs)
+        self.assertFalse("libc6:amd64" in pkgs)
+        self.assertEqual(pkgs.get("libc6"), ("2.11", True))
+        self.assertEqual(pkgs.get("foo"), None)
+        self.assertEqual(list(pkgs)[0], ("bash", "4.1", False))
+        # versions are shared
+        self.assertTrue(pkgs.get("libc6")[0] is pkgs.get("libc6:i386")[0])
+        # set operations by name
+        other = ClonePackageSet([("bash", "4.2", False), ("vim", "7.3", True)])
+        self.assertEqual((pkgs - other).names(),
+                         ["libc6", "libc6:i386", "zsh"])
+        self.assertEqual(list(pkgs & other), [("bash", "4.1", False)])
+        self.assertEqual((pkgs | other).names(),
+                         ["bash", "libc6", "libc6:i386", "vim", "zsh"])
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_get_package_set(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state(
+            "./data/mock-system", self.tempdir, fast=True)
+        pkgs = clone.get_package_set(target)
+        self.assertEqual(list(pkgs), [("2vcard", "0.5-3", False)])
+
+    def _make_fake_cache(self, names, bad):
+        """ return a fake apt cache where marking the packages in bad
+            breaks the cache in a way the resolver can not fix
+        """
+        cache = mock.MagicMock()
+        marked = []
+        pkgs = {}
+        for name in names:
+            pkg = mock.Mock()
+            pkg.name = name
+            pkg.is_installed = False
+            pkg.mark_install.side_effect = (
+                lambda from_user, auto_fix, name=name: marked.append(name))
+            pkgs[name] = pkg
+        def clear():
+            del marked[:]
+        cache.clear.side_effect = clear
+        cache.__contains__.side_effect = lambda name: name in pkgs
+        cache.__getitem__.side_effect = lambda name: pkgs[name]
+        cache.__iter__.side_effect = lambda: iter(pkgs.values())
+        type(cache).broken_count = mock.PropertyMock(
+            side_effect=lambda: len(set(marked) & set(bad)))
+        for pkg in pkgs.values():
+            type(pkg).marked_install = mock.PropertyMock(
+                side_effect=lambda pkg=pkg: pkg.name in marked)
+        return cache, marked
+
+    @mock.patch("apt_pkg.ProblemResolver")
+    def test_restore_package_selection_batch(self, mock_resolver):
+        mock_resolver.return_value.resolve.side_effect = SystemError("broken")
+        installed = os.path.join(self.tempdir, "installed.pkgs")
+        with open(installed, "w") as fp:
+            for i in range(64):
+                fp.write("pkg%02i 1.0 %i\n" % (i, i % 2))
+            fp.write("excluded-pkg 1.0 0\nnot-available 1.0 0\n")
+        statefile = os.path.join(self.tempdir, "clone.tar.gz")
+        with tarfile.open(statefile, "w:gz") as tar:
+            tar.add(installed, arcname="./var/lib/apt-clone/installed.pkgs")
+        clone = AptClone()
+        # all fine, one pass with manual packages before auto ones
+        names = ["pkg%02i" % i for i in range(64)] + ["excluded-pkg"]
+        cache, marked = self._make_fake_cache(names, [])
+        missing = clone._restore_package_selection_in_cache(
+            statefile, cache, protect_installed=True,
+            exclude_pkgs=["excl*"])
+        self.assertEqual(missing, set(["not-available"]))
+        self.assertEqual(cache.clear.call_count, 1)
+        self.assertFalse(mock_resolver.return_value.resolve.called)
+        self.assertEqual(marked[:32], ["pkg%02i" % i for i in range(0, 64, 2)])
+        self.assertEqual(marked[32:], ["pkg%02i" % i for i in range(1, 64, 2)])
+        # one bad package is found by bisection
+        cache, marked = self._make_fake_cache(names, ["pkg17"])
+        missing = clone._restore_package_selection_in_cache(
+            statefile, cache, protect_installed=True,
+            exclude_pkgs=["excl*"])
+        self.assertEqual(missing, set(["not-available", "pkg17"]))
+        self.assertEqual(len(marked), 63)
+        self.assertTrue(cache.clear.call_count < 20)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_check_availability(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        system = os.path.join(self.tempdir, "system")
+        shutil.copytree("./data/mock-system", system)
+        with open(os.path.join(system, "var/lib/dpkg/status"), "a") as fp:
+            fp.write("\nPackage: libfoo\nStatus: install ok installed\n"
+                     "Architecture: i386\nVersion: 1:1.0\n")
+        target = clone.save_state(system, self.tempdir, fast=True)
+        mirror = os.path.join(self.tempdir, "mirror")
+        main = os.path.join(mirror, "lucid/main/binary-i386")
+        os.makedirs(main)
+        # the uncompressed index is used if it is there
+        with open(os.path.join(main, "Packages"), "w") as fp:
+            fp.write("Package: libfoo\nVersion: 1:1.0\nArchitecture: i386\n"
+                     "Description: foo\n Version: 2\n\n"
+                     "Package: 2vcard\nVersion: 0.5-2\nArchitecture: all\n")
+        with gzip.open(os.path.join(main, "Packages.gz"), "wb") as fp:
+            fp.write(b"Package: 2vcard\nVersion: 0.5-3\nArchitecture: all\n")
+        self.assertEqual(
+            clone.check_availability(target, [mirror]),
+            [("2vcard", "0.5-3")])
+        # a compressed index
+        universe = os.path.join(mirror, "lucid/universe/binary-all")
+        os.makedirs(universe)
+        with gzip.open(os.path.join(universe, "Packages.gz"), "wb") as fp:
+            fp.write(b"Package: 2vcard\nVersion: 0.5-3\nArchitecture: all\n")
+        self.assertEqual(clone.check_availability(target, [mirror]), [])
+        # the foreign arch package needs the right arch
+        with open(os.path.join(main, "Packages"), "w") as fp:
+            fp.write("Package: libfoo\nVersion: 1:1.0\n"
+                     "Architecture: armhf\n")
+        self.assertEqual(
+            clone.check_availability(target, [mirror]),
+            [("libfoo:i386", "1:1.0")])
+
+    def test_clone_many(self):
+        roots = []
+        for name in ("a", "b"):
+            root = os.path.join(self.tempdir, "roots", name)
+            shutil.copytree("./data/mock-system", root)
+            roots.append(root)
+        roots.append(os.path.join(self.tempdir, "roots", "missing"))
+        outdir = os.path.join(self.tempdir, "out")
+        clone = AptClone(cache_cls=MockAptCache)
+        results = list(clone.clone_many(roots, outdir, jobs=2, fast=True))
+        results = dict((r["source"], r) for r in results)
+        self.assertEqual(sorted(results), sorted(roots))
+        self.assertTrue("error" in results[roots[2]])
+        self.assertEqual(len(os.listdir(outdir)), 2)
+        for root in roots[:2]:
+            target = results[root]["target"]
+            self.assertTrue(target.startswith(outdir))
+            with StateArchive(target) as archive:
+                self.assertEqual(
+                    archive.read("var/lib/apt-clone/installed.pkgs"),
+                    b"2vcard 0.5-3 0\n")
+        # the config of this process is untouched
+        self.assertEqual(apt_pkg.config.find("Dir"), "/")
+
+    def test_clone_many_targets(self):
+        clone = AptClone(cache_cls=MockAptCache)
+        outdir = os.path.join(self.tempdir, "out")
+        targets = set(clone._get_clone_many_target(root, outdir) for root in
+                      ("/srv/a_b", "/srv/a/b", "/srv/a%5Fb", "/srv/a_/_b",
+                       "/srv/a__/b"))
+        self.assertEqual(len(targets), 5)
+        self.assertEqual(clone._get_clone_many_target("/", outdir),
+                         os.path.join(outdir, "root"))
+        # the same root twice is rejected before anything is cloned
+        with self.assertRaises(ValueError):
+            list(clone.clone_many(["/srv/a", "/srv/b", "/srv/a/"], outdir))
+        self.assertFalse(os.path.exists(outdir))
+
+    def test_clone_many_with_apt_config_lock_held(self):
+        roots = []
+        for name in ("a", "b"):
+            root = os.path.join(self.tempdir, "roots", name)
+            shutil.copytree("./data/mock-system", root)
+            roots.append(root)
+        outdir = os.path.join(self.tempdir, "out")
+        clone = AptClone(cache_cls=MockAptCache)
+        # the workers must not inherit the held lock
+        with apt_clone._apt_config_lock:
+            results = list(clone.clone_many(roots, outdir, fast=True))
+        self.assertEqual([r.get("error") for r in results], [None, None])
+
+    def test_apt_config_isolation(self):
+        apt_pkg.config.set("APT::Clone::Test::", "a")
+        apt_pkg.config.set("APT::Clone::Test::", "b")
+        apt_pkg.config.set("APT::Clone::Text", "line1\nline2")
+        before = apt_pkg.config.dump()
+        roots = []
+        for name in ("a", "b", "c", "d"):
+            root = os.path.join(self.tempdir, "roots", name)
+            shutil.copytree("./data/mock-system", root)
+            roots.append(root)
+        errors = []
+        def save(root):
+            try:
+                clone = AptClone(cache_cls=MockAptCache)
+                clone.save_state(root, root + ".tar.gz", fast=True)
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=save, args=(root,))
+                   for root in roots]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        for root in roots:
+            with StateArchive(root + ".tar.gz") as archive:
+                self.assertEqual(
+                    archive.read("var/lib/apt-clone/installed.pkgs"),
+                    b"2vcard 0.5-3 0\n")
+        self.assertEqual(apt_pkg.config.dump(), before)
+        self.assertEqual(
+            apt_pkg.config.value_list("APT::Clone::Test"), ["a", "b"])
+        self.assertEqual(
+            apt_pkg.config.find("APT::Clone::Text"), "line1\nline2")
+
+    def _make_fleet_clone(self, name, installed, foreign="", hostname=None):
+        fleet = os.path.join(self.tempdir, "fleet")
+        state = tempfile.mkdtemp(dir=self.tempdir)
+        os.makedirs(os.path.join(state, "etc/apt"))
+        os.makedirs(os.path.join(state, "var/lib/apt-clone"))
+        with open(os.path.join(state, "etc/apt/sources.list"), "w") as fp:
+            fp.write("deb http://example.com/ubuntu lucid main\n")
+        for (member, content) in (
+                ("installed.pkgs", installed), ("foreign.pkgs", foreign),
+                ("uname", "hostname: %s\narch: amd64\nkernel: 5.4.0\n"
+                 "uname_arch: x86_64\n" % (hostname or name))):
+            with open(os.path.join(
+                    state, "var/lib/apt-clone", member), "w") as fp:
+                fp.write(content)
+        if not os.path.exists(fleet):
+            os.makedirs(fleet)
+        statefile = os.path.join(fleet, name + ".apt-clone.tar.gz")
+        with tarfile.open(statefile, "w:gz") as tar:
+            tar.add(os.path.join(state, "etc"), arcname="./etc")
+            tar.add(os.path.join(state, "var"), arcname="./var")
+        return statefile
+
+    def test_fleet_index(self):
+        a = self._make_fleet_clone(
+            "a", "openssl 1.0.1-4 0\nfoo 1.0 1\n",
+            "chrome 90.0 Google LLC\n")
+        b = self._make_fleet_clone("b", "openssl 1.1.1-1 0\nfoo 1.0 1\n")
+        c = self._make_fleet_clone("c", "openssl 1.0.1-4 0\nfoo 1.0 1\n")
+        fleet = os.path.dirname(a)
+        with open(os.path.join(fleet, "README"), "w") as fp:
+            fp.write("not a clone file")
+        # neither are other tarballs
+        with tarfile.open(os.path.join(fleet, "backup.tar.gz"), "w:gz"):
+            pass
+        indexfile = os.path.join(self.tempdir, "index", "fleet.db")
+        with FleetIndex(indexfile) as index:
+            self.assertEqual(index.update([fleet]),
+                             {"added": 3, "updated": 0, "unchanged": 0,
+                              "removed": 0, "failed": 0})
+            # a and c share one package set
+            self.assertEqual(index._db.execute(
+                "SELECT COUNT(*) FROM pkgsets").fetchone()[0], 2)
+            result = index.query("openssl", "<<", "1.1")
+            self.assertEqual([(r["hostname"], r["version"]) for r in result],
+                             [("a", "1.0.1-4"), ("c", "1.0.1-4")])
+            self.assertEqual(
+                [r["path"] for r in index.query("open*", ">=", "1.1")], [b])
+            # "<" and ">" are not strict, like in debian/control
+            self.assertEqual(
+                [r["path"] for r in index.query("openssl", "<", "1.0.1-4")],
+                [a, c])
+            self.assertEqual(
+                [r["path"] for r in index.query("openssl", ">", "1.1.1-1")],
+                [b])
+            self.assertEqual(
+                [r["path"] for r in index.query(hostname="[ab]")], [a, b])
+            result = index.query(origin="Google*")
+            self.assertEqual(len(result), 1)
+            self.assertEqual((result[0]["path"], result[0]["package"],
+                              result[0]["origin"]),
+                             (a, "chrome", "Google LLC"))
+            self.assertEqual(index.query(kernel="5.4.0")[0]["uname_arch"],
+                             "x86_64")
+            self.assertRaises(ValueError, index.query, "foo", "~", "1.0")
+        # unchanged files are not read again
+        os.utime(c, (0, 0))
+        os.remove(b)
+        with FleetIndex(indexfile) as index:
+            with mock.patch("apt_clone.StateArchive") as mock_archive:
+                stats = index.update([fleet])
+            self.assertFalse(mock_archive.called)
+            self.assertEqual(stats["unchanged"], 2)
+            self.assertEqual(stats["removed"], 1)
+            self.assertEqual(index.query("openssl", ">=", "1.1"), [])
+            self.assertEqual(index._db.execute(
+                "SELECT COUNT(*) FROM pkgs").fetchone()[0], 2)
+        # changed ones are
+        self._make_fleet_clone("a", "openssl 1.1.1-1 0\n", hostname="a2")
+        with FleetIndex(indexfile) as index:
+            self.assertEqual(index.update([fleet])["updated"], 1)
+            self.assertEqual(
+                [r["hostname"] for r in index.query("openssl", "=", "1.1.1-1")],
+                ["a2"])
+            self.assertEqual(index.query(foreign=True), [])
+
     def test_modified_conffiles(self):
         clone = AptClone()
         modified = clone._find_modified_conffiles("./data/mock-system")
         self.assertEqual(
             modified, set(["./data/mock-system/etc/conffile.modified"]))
 
+    def test_modified_conffiles_digest_cache(self):
+        clone = AptClone()
+        cache = DigestCache(os.path.join(self.tempdir, "digests"))
+        modified = clone._find_modified_conffiles(
+            "./data/mock-system", jobs=4, digest_cache=cache)
+        self.assertEqual(
+            modified, set(["./data/mock-system/etc/conffile.modified"]))
+        self.assertTrue(os.path.exists(cache.cachefile))
+        # unchanged files are not read again
+        cache = DigestCache(os.path.join(self.tempdir, "digests"))
+        with mock.patch("apt_clone._get_md5") as mock_md5:
+            modified = clone._find_modified_conffiles(
+                "./data/mock-system", jobs=4, digest_cache=cache)
+        self.assertFalse(mock_md5.called)
+        self.assertEqual(
+            modified, set(["./data/mock-system/etc/conffile.modified"]))
+        # but changed ones are
+        path = "./data/mock-system/etc/conffile.not-modified"
+        st = os.stat(path)
+        self.addCleanup(os.utime, path, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns + 1000))
+        with mock.patch("apt_clone._get_md5") as mock_md5:
+            mock_md5.return_value = "d41d8cd98f00b204e9800998ecf8427e"
+            clone._find_modified_conffiles(
+                "./data/mock-system", digest_cache=cache)
+        mock_md5.assert_called_once_with(path, DigestCache.CHUNK_SIZE)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_modified_conffiles(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state(
+            "./data/mock-system", self.tempdir, fast=True,
+            with_modified_conffiles=True)
+        with tarfile.open(target) as tar:
+            names = tar.getnames()
+        self.assertTrue("./modified-conffiles/etc/conffile.modified" in names)
+        self.assertFalse(
+            "./modified-conffiles/etc/conffile.not-modified" in names)
+        restoredir = os.path.join(self.tempdir, "restore")
+        with StateArchive(target) as archive:
+            clone._restore_modified_conffiles(archive, restoredir)
+        self.assertTrue(
+            os.path.exists(os.path.join(restoredir, "etc/conffile.modified")))
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_unreadable_conffiles(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        # unreadable conffiles are neither modified nor removed
+        def get_md5(path, *args):
+            raise IOError(errno.EACCES, "Permission denied", path)
+        with mock.patch("apt_clone._get_md5", side_effect=get_md5):
+            target = clone.save_state(
+                "./data/mock-system", os.path.join(self.tempdir, "a"),
+                fast=True, with_modified_conffiles=True)
+        with StateArchive(target) as archive:
+            self.assertFalse("modified-conffiles/etc/conffile.modified"
+                             in archive)
+            self.assertEqual(
+                archive.read("var/lib/apt-clone/removed-conffiles"), b"")
+        # and failing to add one does not fail the clone
+        add = tarfile.TarFile.add
+        def add_unreadable(tar, name, *args, **kwargs):
+            if name.endswith("/etc/conffile.modified"):
+                raise IOError(errno.EACCES, "Permission denied", name)
+            return add(tar, name, *args, **kwargs)
+        with mock.patch.object(tarfile.TarFile, "add", add_unreadable):
+            target = clone.save_state(
+                "./data/mock-system", os.path.join(self.tempdir, "b"),
+                fast=True, with_modified_conffiles=True)
+        with StateArchive(target) as archive:
+            self.assertFalse("modified-conffiles/etc/conffile.modified"
+                             in archive)
+            self.assertTrue("var/lib/apt-clone/installed.pkgs" in archive)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_save_state_unowned_files(self, mock_lowlevel):
+        clone = AptClone(cache_cls=MockAptCache)
+        target = clone.save_state(
+            "./data/mock-system", self.tempdir, fast=True,
+            with_unowned_files=True)
+        with tarfile.open(target) as tar:
+            names = tar.getnames()
+        self.assertTrue("./unowned-files/etc/unowned-file" in names)
+        self.assertFalse("./unowned-files/etc/conffile.modified" in names)
+
     def test_unowned_in_etc(self):
         # test in mock environement
         apt_pkg.config.set(
@@ -183,6 +1045,17 @@ class TestClone(unittest.TestCase):
         self.assertFalse("/etc/conffile.modified" in unowned)
         self.assertFalse("/etc/conffile.not-modified" in unowned)
         self.assertTrue("/etc/unowned-file" in unowned)
+        # same with a persistent ownership index
+        index = OwnershipIndex(os.path.join(self.tempdir, "owners"))
+        self.assertEqual(
+            clone._find_unowned_in_etc("./data/mock-system", index), unowned)
+        # that is not read again if the .list files did not change
+        index = OwnershipIndex(os.path.join(self.tempdir, "owners"))
+        with mock.patch("apt_clone.open", create=True) as mock_open:
+            self.assertEqual(
+                clone._find_unowned_in_etc("./data/mock-system", index),
+                unowned)
+        self.assertFalse(mock_open.called)
         # test on the real system and do very light checks
         apt_pkg.config.set(
             "Dir::state::status",
@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import apt
+import apt_pkg
+import mock
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from apt_clone import AptClone, StateArchive
+
+
+class MockAptCache(apt.Cache):
+    def commit(self, fetchp, installp):
+        pass
+    def update(self, fetchp):
+        pass
+
+
+class TestDeltaClone(unittest.TestCase):
+
+    def setUp(self):
+        for d in apt_pkg.config.keys():
+            apt_pkg.config.clear(d)
+        apt_pkg.init_config()
+        apt_pkg.config.set("Dir", "/")
+        apt_pkg.config.set("dir::state::status", "/var/lib/dpkg/status")
+        self.tempdir = tempfile.mkdtemp("apt-clone-tests")
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        # a copy of the mock system that can be modified
+        self.sourcedir = os.path.join(self.tempdir, "system")
+        shutil.copytree("./data/mock-system", self.sourcedir)
+
+    def _clone(self, name, base=None, **kwargs):
+        clone = AptClone(cache_cls=MockAptCache)
+        return clone.save_state(
+            self.sourcedir, os.path.join(self.tempdir, name), fast=True,
+            base=base, **kwargs)
+
+    def _modify_system(self):
+        status = os.path.join(self.sourcedir, "var/lib/dpkg/status")
+        with open(status) as fp:
+            data = fp.read()
+        with open(status, "w") as fp:
+            fp.write(data.replace("Version: 0.5-3", "Version: 0.5-4"))
+            fp.write("\nPackage: foo\nStatus: install ok installed\n"
+                     "Architecture: all\nVersion: 1.0\n")
+        os.remove(os.path.join(self.sourcedir, "etc/apt/preferences"))
+        with open(os.path.join(self.sourcedir, "etc/apt/sources.list"),
+                  "a") as fp:
+            fp.write("deb http://example.com/ubuntu natty main\n")
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_delta_clone(self, mock_lowlevel):
+        base = self._clone("base")
+        self._modify_system()
+        delta = self._clone("delta", base=base)
+        full = self._clone("full")
+        # the delta only has what changed
+        with tarfile.open(delta) as tar:
+            names = tar.getnames()
+            pkgs = tar.extractfile("./var/lib/apt-clone/delta.pkgs").read()
+            removed = tar.extractfile(
+                "./var/lib/apt-clone/delta-removed").read()
+        self.assertEqual(names[0], "./var/lib/apt-clone/manifest")
+        self.assertTrue("./etc/apt/sources.list" in names)
+        self.assertFalse("./etc/apt/trusted.gpg" in names)
+        self.assertFalse("./var/lib/apt-clone/installed.pkgs" in names)
+        self.assertEqual(pkgs, b"+ 2vcard 0.5-4 0\n+ foo 1.0 0\n")
+        self.assertEqual(removed, b"etc/apt/preferences\n")
+        # but reads like the full clone
+        with StateArchive(delta) as d, StateArchive(full) as f:
+            self.assertEqual(
+                sorted(d.getnames()),
+                sorted(f.getnames() +
+                       ["var/lib/apt-clone/delta-removed",
+                        "var/lib/apt-clone/delta.pkgs"]))
+            for name in f.getnames():
+                if name != "var/lib/apt-clone/manifest":
+                    self.assertEqual(d.get_digest(name), f.get_digest(name))
+        # chains work too
+        delta2 = self._clone("delta2", base=delta)
+        with StateArchive(delta2) as d2, StateArchive(full) as f:
+            self.assertEqual(
+                d2.read("var/lib/apt-clone/installed.pkgs"),
+                f.read("var/lib/apt-clone/installed.pkgs"))
+        self.assertTrue("Installed: 2 pkgs" in AptClone().info(delta2))
+        # and can be compacted into a full clone again
+        compact = os.path.join(self.tempdir, "compact.tar.gz")
+        AptClone().compact(delta2, compact)
+        with StateArchive(compact) as c, StateArchive(full) as f:
+            self.assertEqual(sorted(c.getnames()), sorted(f.getnames()))
+            self.assertFalse(
+                b"Base" in c.read("var/lib/apt-clone/manifest"))
+            self.assertEqual(
+                c.read("var/lib/apt-clone/installed.pkgs"),
+                f.read("var/lib/apt-clone/installed.pkgs"))
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_delta_clone_seekable(self, mock_lowlevel):
+        base = self._clone("base")
+        self._modify_system()
+        delta = self._clone("delta", base=base, seekable=True)
+        full = self._clone("full")
+        self.assertTrue(delta.endswith(".apt-clone.tar"))
+        # a plain tar with its members compressed one by one
+        with open(delta, "rb") as fp:
+            self.assertNotEqual(fp.read(2), b"\x1f\x8b")
+        with tarfile.open(delta) as tar:
+            self.assertTrue("./var/lib/apt-clone/index" in tar.getnames())
+        with StateArchive(delta) as d, StateArchive(full) as f:
+            self.assertTrue(d._has_index())
+            self.assertEqual(
+                d.read("var/lib/apt-clone/installed.pkgs"),
+                f.read("var/lib/apt-clone/installed.pkgs"))
+            self.assertEqual(
+                d.read("etc/apt/sources.list"),
+                f.read("etc/apt/sources.list"))
+            self.assertFalse("etc/apt/preferences" in d)
+
+    @mock.patch("apt_clone.LowLevelCommands")
+    def test_delta_clone_base_changed(self, mock_lowlevel):
+        base = self._clone("base")
+        delta = self._clone("delta", base=base)
+        with open(base, "ab") as fp:
+            fp.write(b"\0")
+        with self.assertRaises(IOError):
+            StateArchive(delta)
+
+
+if __name__ == "__main__":
+    unittest.main()